@@ -3,14 +3,52 @@
 from .logger import setup_logger
 logger = setup_logger()
 
+import sys, types, importlib
 
-import ROOT
-ROOT.gROOT.SetBatch(True)
-ROOT.gROOT.ProcessLine("gErrorIgnoreLevel = kError;")
-ROOT.gStyle.SetOptStat(0)
+# ROOT is only imported (and FWLite loaded) once something needs it (see
+# hgcalhistory.lazyroot). Submodules and names that need ROOT at import time
+# are imported on first access.
+_LAZY_SUBMODULES = [ 'rootutils', 'dataformats', 'rdf' ]
+_LAZY_ATTRIBUTES = dict(
+    Track = 'dataformats',
+    Vertex = 'dataformats',
+    CaloHitWithPosition = 'dataformats',
+    )
 
-from . import utils, rootutils, seutils, physutils
+
+class _LazyPackage(types.ModuleType):
+    def __getattr__(self, name):
+        if name in _LAZY_SUBMODULES:
+            return importlib.import_module('.' + name, __name__)
+        if name in _LAZY_ATTRIBUTES:
+            module = importlib.import_module('.' + _LAZY_ATTRIBUTES[name], __name__)
+            value = getattr(module, name)
+            setattr(self, name, value)
+            return value
+        raise AttributeError(
+            "module '{0}' has no attribute '{1}'".format(__name__, name)
+            )
+
+# This needs to happen before the submodules below import hgcalhistory
+try:
+    sys.modules[__name__].__class__ = _LazyPackage
+    _package = None
+except TypeError:
+    # Python 2 does not allow changing the class of a module; swap in a lazy
+    # copy instead, keeping the original alive (Python 2 clears the globals
+    # of a module when it is garbage collected)
+    _package = _LazyPackage(__name__, __doc__)
+    _package.__dict__.update(sys.modules[__name__].__dict__)
+    _package._original_module = sys.modules[__name__]
+    sys.modules[__name__] = _package
+
+from . import utils, seutils, physutils
 from .event import Event, EventFactory
-from .dataformats import Track, Vertex, CaloHitWithPosition
 from .datacontainers import Histogram2D, Histogram2DFillable
 from .plots import Plot3D, HitsPlot
+
+if _package is not None:
+    # The names imported above went into the globals of the original module
+    _package.__dict__.update(
+        (key, value) for key, value in globals().items() if not key in _package.__dict__
+        )
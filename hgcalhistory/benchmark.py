@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the hot paths, on synthetic events. Run with Python 2 (like
+the rest of the package, which uses implicit relative imports), from the
+repository root or with hgcalhistory installed:
+
+    python -m hgcalhistory.benchmark -o results.json
+    python -m hgcalhistory.benchmark --baseline benchmarks/baseline.json --threshold 0.2
+
+Every benchmark is run `repeat` times over all synthetic events; the fastest
+run counts. Results are written as json. Against a baseline, a benchmark is a
+regression if it is more than `threshold` (fractionally) slower; the exit code
+is then 1. A baseline can set per-benchmark thresholds under 'thresholds'.
+benchmarks/baseline.json in the repository is the reference result, made with
+Python 2.7 and -r 15 (its 'environment' says where; it lacks the ROOT
+benchmarks). Timings depend on the machine and its load, so regenerate it
+with -o on the machine where you compare.
+Benchmarks that need ROOT (TH2 conversion, plotting) are skipped without it.
+"""
+from __future__ import print_function
+import sys, logging, json, platform, tempfile, shutil, argparse
+import numpy as np
+from timeit import default_timer
+import hgcalhistory
+logger = logging.getLogger('hgcalhistory')
+
+from synthetic import generate_events, StandInTree
+from event import Event
+from bulk import join_by_id
+from lazyroot import load as load_root
+
+# name -> (function, requires_root)
+BENCHMARKS = {}
+BENCHMARK_ORDER = []
+
+DEFAULT_THRESHOLD = 0.2
+
+
+def benchmark(name, requires_root=False):
+    """
+    Registers a benchmark function, which takes a BenchmarkContext
+    """
+    def decorator(func):
+        BENCHMARKS[name] = (func, requires_root)
+        BENCHMARK_ORDER.append(name)
+        return func
+    return decorator
+
+
+def root_available():
+    try:
+        load_root()
+        return True
+    except ImportError:
+        return False
+
+
+class BenchmarkContext(object):
+    """
+    The synthetic events, as a stand-in tree and as array-backed Events
+    """
+    def __init__(self, n_events=20, seed=1, **kwargs):
+        super(BenchmarkContext, self).__init__()
+        self.config = dict(kwargs, n_events=n_events, seed=seed)
+        self.event_arrays = generate_events(n_events, seed=seed, **kwargs)
+        self.tree = StandInTree(self.event_arrays)
+        self.events = [
+            Event(None, entry=i, arrays=arrays) for i, arrays in enumerate(self.event_arrays)
+            ]
+        self.plotdir = None
+
+    def get_histogram(self):
+        hist = hgcalhistory.datacontainers.Histogram2DFillable()
+        hist.set_x_bin_boundaries(np.linspace(0., 54., 55))
+        hist.set_y_bin_boundaries(np.linspace(-250., 250., 200))
+        hist.clear_data()
+        return hist
+
+    def __enter__(self):
+        # Plots go to a temporary directory
+        self.plotdir = tempfile.mkdtemp(prefix='hgcalhistory_benchmark_')
+        return self
+
+    def __exit__(self, *args):
+        shutil.rmtree(self.plotdir, ignore_errors=True)
+
+
+@benchmark('event_construction')
+def bench_event_construction(ctx):
+    for i in range(len(ctx.event_arrays)):
+        ctx.tree.LoadTree(i)
+        event = Event(ctx.tree, entry=i)
+        event.get_hit_arrays()
+        event.get_track_arrays()
+        event.get_vertex_arrays()
+
+@benchmark('hits_columnar')
+def bench_hits_columnar(ctx):
+    for event in ctx.events:
+        event.get_hits_columnar()
+
+@benchmark('tracks_columnar')
+def bench_tracks_columnar(ctx):
+    for event in ctx.events:
+        event.get_tracks_columnar()
+
+@benchmark('id_lookups')
+def bench_id_lookups(ctx):
+    for event in ctx.events:
+        event._track_index_map = None
+        event._vertex_index_map = None
+        track_ids = event.get_hit_arrays()['track_id']
+        index_map = event.track_index_map
+        event.vertex_index_map
+        for track_id in track_ids[:100].tolist():
+            index_map.get(track_id, None)
+        join_by_id(
+            event.get_track_arrays()['id'], event.get_track_arrays()['pdgid'], track_ids
+            )
+
+@benchmark('history')
+def bench_history(ctx):
+    for event in ctx.events:
+        event._history = None
+        event.history.get_hit_ancestry()
+
+@benchmark('histogram_fill')
+def bench_histogram_fill(ctx):
+    hist = ctx.get_histogram()
+    for event in ctx.events:
+        hits = event.get_hit_arrays()
+        hist.fill_many(hits['layer'], hits['x'], hits['energy'])
+
+@benchmark('th2_conversion', requires_root=True)
+def bench_th2_conversion(ctx):
+    hist = ctx.get_histogram()
+    hits = ctx.events[0].get_hit_arrays()
+    hist.fill_many(hits['layer'], hits['x'], hits['energy'])
+    for _ in ctx.events:
+        hist.to_TH2().Delete()
+
+@benchmark('plot_hits', requires_root=True)
+def bench_plot_hits(ctx):
+    hgcalhistory.rootutils.PLOTDIR = ctx.plotdir
+    for event in ctx.events:
+        hgcalhistory.plots.HitsPlot('bench_{0}'.format(event.entry)).plot(event)
+
+@benchmark('plot_3d', requires_root=True)
+def bench_plot_3d(ctx):
+    hgcalhistory.rootutils.PLOTDIR = ctx.plotdir
+    for event in ctx.events:
+        hgcalhistory.plots.Plot3DWithCaloHits('bench_{0}'.format(event.entry)).plot(event)
+
+
+def time_function(func, ctx, repeat=5):
+    """
+    Returns the wall times of `repeat` calls of func(ctx). Warnings are
+    silenced meanwhile; the synthetic events trigger them on purpose.
+    """
+    times = []
+    logging.disable(logging.WARNING)
+    try:
+        for _ in range(repeat):
+            t_start = default_timer()
+            func(ctx)
+            times.append(default_timer() - t_start)
+    finally:
+        logging.disable(logging.NOTSET)
+    return times
+
+
+def run(names=None, repeat=5, **kwargs):
+    """
+    Runs the benchmarks (default: all) and returns the results as a dict;
+    kwargs go to BenchmarkContext
+    """
+    has_root = root_available()
+    results = {}
+    skipped = []
+    with BenchmarkContext(**kwargs) as ctx:
+        for name in BENCHMARK_ORDER if names is None else names:
+            func, requires_root = BENCHMARKS[name]
+            if requires_root and not has_root:
+                skipped.append(name)
+                continue
+            times = time_function(func, ctx, repeat)
+            results[name] = dict(
+                min = min(times),
+                median = float(np.median(times)),
+                per_event = min(times) / len(ctx.events),
+                repeat = repeat,
+                )
+            logger.info('%s: %.4f s', name, min(times))
+    if skipped:
+        logger.warning('Skipped benchmarks that need ROOT: %s', ', '.join(skipped))
+    return dict(
+        config = dict(ctx.config, repeat=repeat),
+        environment = dict(
+            python = platform.python_version(),
+            numpy = np.__version__,
+            root = has_root,
+            machine = platform.node(),
+            ),
+        results = results,
+        skipped = skipped,
+        )
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares results to baseline (both as returned by run). Returns a list of
+    (name, baseline time, time, ratio, status) with status 'ok', 'faster' or
+    'regression'.
+    """
+    thresholds = baseline.get('thresholds', {})
+    comparison = []
+    for name in BENCHMARK_ORDER:
+        if not(name in results['results'] and name in baseline['results']):
+            continue
+        reference = baseline['results'][name]['min']
+        time = results['results'][name]['min']
+        ratio = time / reference if reference > 0. else float('inf')
+        max_ratio = 1. + thresholds.get(name, threshold)
+        if ratio > max_ratio:
+            status = 'regression'
+        elif ratio < 1. / max_ratio:
+            status = 'faster'
+        else:
+            status = 'ok'
+        comparison.append((name, reference, time, ratio, status))
+    return comparison
+
+
+def print_table(columns, rows, stream=None):
+    writer = hgcalhistory.utils.TableWriter(
+        sys.stdout if stream is None else stream, columns, width=18
+        )
+    writer.write_rows(rows)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('-o', '--output', type=str, help='Write the results to this json file')
+    parser.add_argument('-b', '--baseline', type=str, help='Compare to the results in this json file')
+    parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('-n', '--n-events', type=int, default=20)
+    parser.add_argument('--n-tracks', type=int, default=500)
+    parser.add_argument('--n-vertices', type=int, default=250)
+    parser.add_argument('--n-hits', type=int, default=5000)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run (default: all)')
+    args = parser.parse_args(args)
+
+    for name in args.benchmarks:
+        if not name in BENCHMARKS:
+            parser.error('Unknown benchmark {0}; choose from {1}'.format(name, ', '.join(BENCHMARK_ORDER)))
+
+    results = run(
+        names = args.benchmarks or None,
+        repeat = args.repeat,
+        n_events = args.n_events,
+        seed = args.seed,
+        n_tracks = args.n_tracks,
+        n_vertices = args.n_vertices,
+        n_hits = args.n_hits,
+        )
+    print_table(
+        [ 'benchmark', 'min [ms]', 'median [ms]', 'per event [ms]' ],
+        [
+            (name, 1e3*r['min'], 1e3*r['median'], 1e3*r['per_event'])
+            for name, r in sorted(results['results'].items(), key=lambda i: BENCHMARK_ORDER.index(i[0]))
+            ]
+        )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        logger.info('Wrote results to %s', args.output)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('config', {}).get('n_events') != results['config']['n_events']:
+            logger.warning('Baseline was made with a different configuration: %s', baseline.get('config'))
+        comparison = compare(results, baseline, args.threshold)
+        print_table(
+            [ 'benchmark', 'baseline [ms]', 'now [ms]', 'ratio', 'status' ],
+            [ (name, 1e3*ref, 1e3*t, ratio, status) for name, ref, t, ratio, status in comparison ]
+            )
+        regressions = [ c[0] for c in comparison if c[4] == 'regression' ]
+        if regressions:
+            logger.error('Regressions: %s', ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
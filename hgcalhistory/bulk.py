@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bulk readout of the EDM collections into numpy arrays.
+
+Small C++ helpers are declared to cling on first use. They copy the fields of
+every object in a collection into one flat numpy buffer, so a whole collection
+crosses into Python in a single call instead of one PyROOT call per field per
+object. Plain Python lists of objects with the same interface (e.g. the
+stand-ins of hgcalhistory.synthetic) are read with a Python loop instead.
+"""
+from __future__ import print_function
+import logging
+import numpy as np
+logger = logging.getLogger('hgcalhistory')
+
+from lazyroot import ROOT
+
+
+HIT_FIELDS = (
+    'x', 'y', 'z', 'layer', 'time', 'energy', 'track_id', 'id',
+    'inEE', 'inHsi', 'inHsc',
+    )
+TRACK_FIELDS = ('x', 'y', 'z', 'energy', 'pdgid', 'id', 'vertex_index')
+VERTEX_FIELDS = ('x', 'y', 'z', 'id', 'track_id')
+
+INT_FIELDS = set([ 'layer', 'track_id', 'id', 'pdgid', 'vertex_index' ])
+BOOL_FIELDS = set([ 'inEE', 'inHsi', 'inHsc' ])
+
+_CPP_HELPERS = r'''
+namespace hgcalhistory {
+
+void fill_hits(const std::vector<PCaloHitWithPosition>& hits, double* out){
+    const size_t n_fields = %(n_hit_fields)s;
+    for (size_t i = 0; i < hits.size(); ++i){
+        const PCaloHitWithPosition& hit = hits[i];
+        double* row = out + i * n_fields;
+        row[0] = hit.position_.x();
+        row[1] = hit.position_.y();
+        row[2] = hit.position_.z();
+        row[3] = hit.layer_;
+        row[4] = hit.time();
+        row[5] = hit.energy();
+        row[6] = hit.geantTrackId();
+        row[7] = hit.id();
+        row[8] = hit.inEE_;
+        row[9] = hit.inHsi_;
+        row[10] = hit.inHsc_;
+        }
+    }
+
+void fill_tracks(const std::vector<SimTrack>& tracks, double* out){
+    const size_t n_fields = %(n_track_fields)s;
+    for (size_t i = 0; i < tracks.size(); ++i){
+        const SimTrack& track = tracks[i];
+        double* row = out + i * n_fields;
+        row[0] = track.trackerSurfacePosition().X();
+        row[1] = track.trackerSurfacePosition().Y();
+        row[2] = track.trackerSurfacePosition().Z();
+        row[3] = track.momentum().E();
+        row[4] = track.type();
+        row[5] = track.trackId();
+        row[6] = track.vertIndex();
+        }
+    }
+
+void fill_vertices(const std::vector<SimVertex>& vertices, double* out){
+    const size_t n_fields = %(n_vertex_fields)s;
+    for (size_t i = 0; i < vertices.size(); ++i){
+        const SimVertex& vertex = vertices[i];
+        double* row = out + i * n_fields;
+        row[0] = vertex.position().X();
+        row[1] = vertex.position().Y();
+        row[2] = vertex.position().Z();
+        row[3] = vertex.vertexId();
+        row[4] = vertex.parentIndex();
+        }
+    }
+
+}
+''' % dict(
+    n_hit_fields = len(HIT_FIELDS),
+    n_track_fields = len(TRACK_FIELDS),
+    n_vertex_fields = len(VERTEX_FIELDS),
+    )
+
+# Python equivalents of the C++ helpers, for plain Python collections
+_PY_FILL_FUNCTIONS = dict(
+    fill_hits = lambda hit: (
+        hit.position_.x(), hit.position_.y(), hit.position_.z(), hit.layer_,
+        hit.time(), hit.energy(), hit.geantTrackId(), hit.id(),
+        hit.inEE_, hit.inHsi_, hit.inHsc_,
+        ),
+    fill_tracks = lambda track: (
+        track.trackerSurfacePosition().X(), track.trackerSurfacePosition().Y(),
+        track.trackerSurfacePosition().Z(), track.momentum().E(), track.type(),
+        track.trackId(), track.vertIndex(),
+        ),
+    fill_vertices = lambda vertex: (
+        vertex.position().X(), vertex.position().Y(), vertex.position().Z(),
+        vertex.vertexId(), vertex.parentIndex(),
+        ),
+    )
+
+_HELPERS_DECLARED = False
+def declare_helpers():
+    """
+    Compiles the C++ helpers; only does work on the first call
+    """
+    global _HELPERS_DECLARED
+    if _HELPERS_DECLARED: return
+    logger.debug('Declaring bulk readout helpers to cling')
+    if not ROOT.gInterpreter.Declare(_CPP_HELPERS):
+        raise RuntimeError('Could not compile the bulk readout helpers')
+    _HELPERS_DECLARED = True
+
+
+def _read(collection, fields, fill_function_name):
+    """
+    Runs one of the C++ fill functions on `collection` and splits the flat
+    buffer into a dict of typed column arrays
+    """
+    n = len(collection) if isinstance(collection, list) else collection.size()
+    buffer = np.zeros(n * len(fields), dtype=np.float64)
+    if n > 0 and isinstance(collection, list):
+        fill = _PY_FILL_FUNCTIONS[fill_function_name]
+        buffer[:] = np.array([ fill(o) for o in collection ], dtype=np.float64).ravel()
+    elif n > 0:
+        declare_helpers()
+        getattr(ROOT.hgcalhistory, fill_function_name)(collection, buffer)
+    table = buffer.reshape((n, len(fields)))
+    arrays = {}
+    for i, field in enumerate(fields):
+        column = table[:,i]
+        if field in BOOL_FIELDS:
+            column = column != 0.
+        elif field in INT_FIELDS:
+            column = column.astype(np.int64)
+        else:
+            column = column.copy()
+        arrays[field] = column
+    return arrays
+
+
+def read_hits(collection):
+    """
+    Reads a std::vector<PCaloHitWithPosition> into a dict of arrays with keys
+    HIT_FIELDS
+    """
+    return _read(collection, HIT_FIELDS, 'fill_hits')
+
+
+def read_tracks(collection):
+    """
+    Reads a std::vector<SimTrack> into a dict of arrays with keys TRACK_FIELDS
+    """
+    return _read(collection, TRACK_FIELDS, 'fill_tracks')
+
+
+def read_vertices(collection):
+    """
+    Reads a std::vector<SimVertex> into a dict of arrays with keys VERTEX_FIELDS.
+    Note 'track_id' is the id of the parent track, not an index.
+    """
+    return _read(collection, VERTEX_FIELDS, 'fill_vertices')
+
+
+def select(arrays, mask):
+    """
+    Applies a boolean mask (or index array) to every column in `arrays`
+    """
+    return { key : column[mask] for key, column in arrays.items() }
+
+
+def join_by_id(ids, values, query_ids, default=0):
+    """
+    For every element in `query_ids`, returns the entry of `values` belonging to
+    the same id in `ids`, or `default` if the id does not occur.
+    Uses a sorted join, so this is O((n + m) log n) rather than O(n * m).
+    For duplicate ids the first occurrence wins.
+    """
+    ids = np.asarray(ids)
+    values = np.asarray(values)
+    query_ids = np.asarray(query_ids)
+    if len(ids) == 0:
+        return np.full(query_ids.shape, default, dtype=values.dtype)
+    order = np.argsort(ids, kind='mergesort')
+    sorted_ids = ids[order]
+    positions = np.searchsorted(sorted_ids, query_ids)
+    positions = np.clip(positions, 0, len(ids) - 1)
+    found = sorted_ids[positions] == query_ids
+    return np.where(found, values[order][positions], default)
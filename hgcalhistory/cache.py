@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+On-disk columnar cache of root files.
+
+A root file is converted once into the outputs of Event.get_hits_columnar and
+Event.get_tracks_columnar (with default arguments) for all its events, stored
+as .npy files with per-event offsets. Later reads memory-map those files.
+Entries are keyed by path, size and modification time of the root file, so a
+changed file gets a fresh entry.
+"""
+from __future__ import print_function
+import os, shutil, logging, hashlib, uuid
+import os.path as osp, numpy as np
+import hgcalhistory
+logger = logging.getLogger('hgcalhistory')
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'HGCALHISTORY_CACHE',
+    osp.join(osp.expanduser('~'), '.cache', 'hgcalhistory')
+    )
+
+COLLECTIONS = [ 'hits', 'tracks' ]
+
+
+def get_size_and_mtime(rootfile, use_cache=True):
+    """
+    Returns (size, mtime) of a local or remote (root://) file. With
+    use_cache=False a remote file is always stat'ed anew, instead of possibly
+    using the SE metadata cache of seutils.
+    """
+    if rootfile.startswith('root:'):
+        statinfo = hgcalhistory.seutils.get_statinfo(rootfile, use_cache=use_cache)
+        if statinfo is None:
+            raise OSError('Could not stat {0}'.format(rootfile))
+        return statinfo.size, statinfo.modtime
+    stat = os.stat(rootfile)
+    return stat.st_size, int(stat.st_mtime)
+
+
+def cache_key(rootfile):
+    """
+    Returns a key that changes when the path, size or mtime of rootfile change
+    """
+    if not rootfile.startswith('root:'):
+        rootfile = osp.abspath(rootfile)
+    # Not from the metadata cache: a file rewritten within its TTL would
+    # otherwise keep its old key
+    size, mtime = get_size_and_mtime(rootfile, use_cache=False)
+    return hashlib.sha1(
+        '{0}|{1}|{2}'.format(rootfile, size, mtime).encode('utf-8')
+        ).hexdigest()
+
+
+class CachedColumns(object):
+    """
+    The cached columns of one root file. get(i) returns the (hits, tracks)
+    columnar arrays of event i, as views into memory-mapped files.
+    """
+    def __init__(self, directory):
+        super(CachedColumns, self).__init__()
+        self.directory = directory
+        self.columns = {}
+        self.offsets = {}
+        for collection in COLLECTIONS:
+            self.columns[collection] = np.load(
+                osp.join(directory, collection + '.npy'), mmap_mode='r'
+                )
+            self.offsets[collection] = np.load(
+                osp.join(directory, collection + '_offsets.npy')
+                )
+        self.n_events = len(self.offsets['hits']) - 1
+
+    def __len__(self):
+        return self.n_events
+
+    def _get_collection(self, collection, i):
+        offsets = self.offsets[collection]
+        return self.columns[collection][offsets[i]:offsets[i+1]]
+
+    def get(self, i):
+        return self._get_collection('hits', i), self._get_collection('tracks', i)
+
+
+class ColumnarCache(object):
+    """
+    Manages a directory of CachedColumns, one subdirectory per cache key
+    """
+    def __init__(self, directory=None):
+        super(ColumnarCache, self).__init__()
+        self.directory = DEFAULT_CACHE_DIR if directory is None else directory
+
+    def get_path(self, rootfile):
+        return osp.join(self.directory, cache_key(rootfile))
+
+    def is_warm(self, rootfile):
+        return osp.isdir(self.get_path(rootfile))
+
+    def fill(self, rootfile, path=None):
+        """
+        Converts rootfile to the columnar format. Writes to a temporary
+        directory first, so an interrupted fill does not leave a broken entry.
+        """
+        if path is None: path = self.get_path(rootfile)
+        logger.info('Filling columnar cache for %s in %s', rootfile, path)
+        columns = { collection : [] for collection in COLLECTIONS }
+        for event in hgcalhistory.event.EventFactory(rootfile):
+            columns['hits'].append(event.get_hits_columnar())
+            columns['tracks'].append(event.get_tracks_columnar())
+
+        tmp_path = path + '.tmp-{0}'.format(uuid.uuid4())
+        os.makedirs(tmp_path)
+        try:
+            for collection, arrays in columns.items():
+                offsets = np.zeros(len(arrays)+1, dtype=np.int64)
+                offsets[1:] = np.cumsum([ len(a) for a in arrays ])
+                data = np.concatenate(arrays) if len(arrays) else np.zeros((0, 9))
+                np.save(osp.join(tmp_path, collection + '.npy'), data)
+                np.save(osp.join(tmp_path, collection + '_offsets.npy'), offsets)
+            os.rename(tmp_path, path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not osp.isdir(path):
+                raise
+            # Another process filled the same entry in the meantime
+            logger.info('Cache entry %s was filled concurrently', path)
+
+    def load(self, rootfile):
+        """
+        Returns the CachedColumns for rootfile, filling the cache if needed
+        """
+        path = self.get_path(rootfile)
+        if not osp.isdir(path):
+            self.fill(rootfile, path)
+        return CachedColumns(path)
+
+    def clear(self):
+        logger.warning('Deleting columnar cache %s', self.directory)
+        shutil.rmtree(self.directory, ignore_errors=True)
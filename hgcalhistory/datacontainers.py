@@ -5,10 +5,46 @@ import os, shutil, logging, uuid
 import os.path as osp, numpy as np
 from array import array
 import hgcalhistory
+from instrument import timed
 logger = logging.getLogger('hgcalhistory')
 
-import ROOT
-
+from lazyroot import ROOT
+
+
+class NearestBin(object):
+    """
+    Finds the index of the bin center nearest to x, for a scalar or an array x.
+    Values outside the range go to the first or last bin; exactly halfway
+    between two centers the lower bin wins.
+    Uniformly spaced centers use arithmetic (corrected against the midpoints
+    between centers), other increasing centers a searchsorted on the
+    midpoints.
+    """
+    def __init__(self, centers):
+        super(NearestBin, self).__init__()
+        self.centers = np.asarray(centers, dtype=np.float64)
+        self.n = len(self.centers)
+        widths = np.diff(self.centers)
+        self.is_uniform = self.n > 1 and np.allclose(widths, widths[0], rtol=1e-9, atol=0.)
+        self.is_increasing = np.all(widths > 0.)
+        self.midpoints = (self.centers[:-1] + self.centers[1:]) / 2.
+
+    def __call__(self, x):
+        if self.is_uniform:
+            x = np.asarray(x, dtype=np.float64)
+            width = self.centers[1] - self.centers[0]
+            i = np.clip(np.rint((x - self.centers[0]) / width), 0, self.n - 1).astype(np.int64)
+            # Rounding errors can put x one bin off near a midpoint; compare to
+            # the midpoints themselves, like searchsorted does
+            i -= (i > 0) & (x <= self.midpoints[np.maximum(i-1, 0)])
+            i += (i < self.n - 1) & (x > self.midpoints[np.minimum(i, self.n - 2)])
+            return i
+        elif self.is_increasing:
+            return np.searchsorted(self.midpoints, x)
+        elif np.ndim(x) == 0:
+            return np.abs(self.centers - x).argmin()
+        else:
+            return np.abs(self.centers[None,:] - np.asarray(x)[:,None]).argmin(axis=1)
 
 
 class Histogram2D(object):
@@ -22,10 +58,12 @@ class Histogram2D(object):
     def set_x_bin_boundaries(self, bounds):
         self.x_bin_boundaries = bounds
         self.x_bin_centers = (bounds[:-1] + bounds[1:]) / 2.
+        self._nearest_bin_x = NearestBin(self.x_bin_centers)
 
     def set_y_bin_boundaries(self, bounds):
         self.y_bin_boundaries = bounds
         self.y_bin_centers = (bounds[:-1] + bounds[1:]) / 2.
+        self._nearest_bin_y = NearestBin(self.y_bin_centers)
 
     @property
     def n_bins_x(self):
@@ -44,10 +82,10 @@ class Histogram2D(object):
         return len(self.y_bin_boundaries)
 
     def find_nearest_bin_x(self, x):
-        return (np.abs(self.x_bin_centers - x)).argmin()
+        return self._nearest_bin_x(x)
 
     def find_nearest_bin_y(self, y):
-        return (np.abs(self.y_bin_centers - y)).argmin()
+        return self._nearest_bin_y(y)
 
     def _prepare_data(self):
         if self.data is None:
@@ -57,6 +95,7 @@ class Histogram2D(object):
         self.data = None
         self._prepare_data()
 
+    @timed('Histogram2D.to_TH2')
     def to_TH2(self):
         TH2 = ROOT.TH2D(
             'TH2_{0}'.format(uuid.uuid4()), '',
@@ -64,11 +103,70 @@ class Histogram2D(object):
             self.n_bins_y, array('d', self.y_bin_boundaries),
             )
         ROOT.SetOwnership(TH2, False)
-        for i_x in xrange(self.n_bins_x):
-            for i_y in xrange(self.n_bins_y):
-                TH2.SetBinContent(i_x+1, i_y+1, self.data[i_x][i_y])
+        # A TH2D stores its bins, including under- and overflow, as one flat
+        # array with index i_x + (n_bins_x+2) * i_y
+        contents = np.zeros((self.n_bins_y+2, self.n_bins_x+2))
+        contents[1:-1,1:-1] = np.asarray(self.data).T
+        TH2.Set(contents.size, contents.ravel())
+        TH2.SetEntries(self.data.size)
         return TH2
 
+    @classmethod
+    def from_TH2(cls, TH2):
+        """
+        Creates a histogram with the binning and contents of TH2 (under- and
+        overflow bins are dropped)
+        """
+        hist = cls()
+        hist.set_x_bin_boundaries(_get_bin_boundaries(TH2.GetXaxis()))
+        hist.set_y_bin_boundaries(_get_bin_boundaries(TH2.GetYaxis()))
+        dtype = _get_TH2_dtype(TH2)
+        if dtype is None:
+            # Profiles store sums, other classes have no plain array
+            hist.data = np.array([
+                [ TH2.GetBinContent(i_x+1, i_y+1) for i_y in range(hist.n_bins_y) ]
+                for i_x in range(hist.n_bins_x)
+                ], dtype=np.float64).reshape((hist.n_bins_x, hist.n_bins_y))
+            return hist
+        n_x = hist.n_bins_x + 2
+        n_y = hist.n_bins_y + 2
+        contents = hgcalhistory.rootutils.buffer_to_numpy(TH2.GetArray(), n_x * n_y, dtype)
+        hist.data = contents.reshape((n_y, n_x))[1:-1,1:-1].T.astype(np.float64)
+        return hist
+
+
+# Element type of the bin array of the TH2 classes that store their contents
+# as a plain array
+TH2_DTYPES = [
+    ('TH2D', np.float64),
+    ('TH2F', np.float32),
+    ('TH2I', np.int32),
+    ('TH2S', np.int16),
+    ]
+
+def _get_TH2_dtype(TH2):
+    """
+    Returns the numpy dtype of the bin array of TH2, or None if the bin
+    contents should be read bin by bin
+    """
+    if TH2.InheritsFrom('TProfile2D'):
+        return None
+    for class_name, dtype in TH2_DTYPES:
+        if TH2.InheritsFrom(class_name):
+            return dtype
+    return None
+
+
+def _get_bin_boundaries(axis):
+    """
+    Returns the bin boundaries of a TAxis as a numpy array
+    """
+    n_bins = axis.GetNbins()
+    variable_bins = axis.GetXbins()
+    if variable_bins.GetSize() == 0:
+        return np.linspace(axis.GetXmin(), axis.GetXmax(), n_bins+1)
+    return hgcalhistory.rootutils.buffer_to_numpy(variable_bins.GetArray(), n_bins+1)
+
 
 class Histogram2DFillable(Histogram2D):
 
@@ -78,6 +176,17 @@ class Histogram2DFillable(Histogram2D):
         i_y = self.find_nearest_bin_y(y)
         self.data[i_x][i_y] += value
 
+    @timed('Histogram2DFillable.fill_many')
+    def fill_many(self, xs, ys, values):
+        """
+        Like fill, but for arrays of xs, ys and values in one go
+        """
+        self._prepare_data()
+        i_flat = self.find_nearest_bin_x(xs) * self.n_bins_y + self.find_nearest_bin_y(ys)
+        self.data += np.bincount(
+            np.asarray(i_flat, dtype=np.int64), weights=values, minlength=self.data.size
+            ).reshape(self.data.shape)
+
     def get_value(self, x, y):
         self._prepare_data()
         i_x = self.find_nearest_bin_x(x)
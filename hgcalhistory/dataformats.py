@@ -9,7 +9,7 @@ import hgcalhistory
 
 logger = logging.getLogger('hgcalhistory')
 
-import ROOT
+from lazyroot import ROOT
 
 
 class Vertex(ROOT.SimVertex):
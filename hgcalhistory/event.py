@@ -5,115 +5,612 @@ import os.path as osp, numpy as np, glob
 from array import array
 import hgcalhistory
 logger = logging.getLogger('hgcalhistory')
-import ROOT
+from lazyroot import ROOT
 
 import utils
+import bulk
+import instrument
+from instrument import timed
+from cache import ColumnarCache
+from staging import StagingCache
+from summary import SummaryIndex
+from skim import SkimFile, write_skim
+from history import History
 from physutils import (
     hgcal_zmin_pos,
     hgcal_zmax_pos,
     hgcal_zmin_neg,
     hgcal_zmax_neg,
+    in_hgcal,
     )
 
+TRACKS_BRANCH = 'SimTracks_g4SimHits__SIM'
+VERTEXS_BRANCH = 'SimVertexs_g4SimHits__SIM'
+CALOHITS_BRANCH = 'PCaloHitWithPositions_PCaloHitWithPositionProducer__SIM'
+
+# The branches Event reads
+DEFAULT_BRANCHES = [ TRACKS_BRANCH, VERTEXS_BRANCH, CALOHITS_BRANCH ]
+DEFAULT_CACHE_SIZE = 30 * 1024 * 1024 # bytes
+
+# Columns of Event.dump_content
+CONTENT_COLUMNS = (
+    'entry', 'kind', 'id', 'volume', 'pdgid', 'energy', 'x', 'y', 'z',
+    'track_id', 'vertex_id', 'parent_track_id',
+    )
+
+
 class EventFactory(object):
+    """
+    Iterates over the events in a set of root files.
+
+    Keyword arguments:
+    `max_events`: stop after this many events
+    `branches`: 'auto' (default) to only read the branches Event needs, a list
+        of branch names to read in addition to those, or None to read all
+        branches
+    `cache_size`: size in bytes of the TTreeCache for the selected branches
+    `cache`: a hgcalhistory.cache.ColumnarCache, or True for the default one.
+        Root files are converted to the cache on first use; after that
+        get_hits_columnar and get_tracks_columnar (with default arguments) are
+        served from the cache without reading the root files.
+    `staging`: a hgcalhistory.staging.StagingCache, or True for the default
+        one. Remote files are copied to local disk before their events are
+        read, and the next files are copied in the background meanwhile. The
+        remote files are never opened: entry counts come from the staged
+        copies as iteration reaches them, so len(), file_entry_offsets() and
+        random access past the staged files stage the files before them.
+
+    Skim files (.npz, see EventFactory.write_skim) can be passed instead of
+    root files; their events are read from the skim arrays only.
+
+    See EventFactory.map to process the events on multiple cores.
+    """
     def __init__(self, *args, **kwargs):
         super(EventFactory, self).__init__()
         self.rootfiles = []
+        self.skimfiles = []
         for path in args:
             if path.endswith('.root'):
                 self.rootfiles.append(path)
+            elif path.endswith('.npz'):
+                self.skimfiles.append(path)
             elif path.startswith('root:'):
-                import qondor
-                qondor.subprocess_logger.setLevel(logging.ERROR)
-                self.rootfiles.extend(qondor.seutils.ls_root(path))
+                self.rootfiles.extend(utils.smart_list_root_files(path))
             else:
                 self.rootfiles.extend(glob.glob(osp.join(path, '*.root')))
+        self.kwargs = kwargs
         self.max_events = kwargs.get('max_events', None)
+        self.branches = kwargs.get('branches', 'auto')
+        if self.branches == 'auto':
+            self.branches = DEFAULT_BRANCHES
+        elif self.branches is not None:
+            # Event always needs its own branches
+            self.branches = DEFAULT_BRANCHES + [
+                branch for branch in self.branches if not branch in DEFAULT_BRANCHES
+                ]
+        self.cache_size = kwargs.get('cache_size', DEFAULT_CACHE_SIZE)
+        self.cache = kwargs.get('cache', None)
+        if self.cache is True:
+            self.cache = ColumnarCache()
+        self.staging = kwargs.get('staging', None)
+        if self.staging is True:
+            self.staging = StagingCache()
+        self._staged_n_entries = None
+        self._staged_file_index = None
+        self._staged_begin = None
+        self._staged_tree = None
+        if self.skimfiles:
+            self._init_skims()
+            return
+        self.skims = None
+        if self.staging is not None and self.cache is None:
+            self._init_staging()
+            return
         self.tree = ROOT.TChain('Events')
         for rootfile in self.rootfiles:
             self.tree.Add(rootfile)
         # self.tree.__class__ = Event
-        self.n_events = self.tree.GetEntries()
+        if self.cache is None:
+            self.cached_columns = None
+            self.n_events = self.tree.GetEntries()
+        else:
+            # Entry counts come from the cache, so the chain is only opened
+            # once an event needs something that is not cached
+            self.cached_columns = [ self.cache.load(f) for f in self.rootfiles ]
+            self._cached_offsets = np.cumsum([0] + [ len(c) for c in self.cached_columns ])
+            self.n_events = int(self._cached_offsets[-1])
+        self.select_branches(self.tree, load=self.cache is None)
         logger.info(
             'Initialized factory with %s root files, %s events',
             len(self.rootfiles), self.n_events
             )
 
+    def _init_staging(self):
+        # Entry counts per file, filled in as files are staged
+        self._staged_n_entries = [ None for _ in self.rootfiles ]
+        self.n_events = None if self.rootfiles else 0
+        self.tree = None
+        self.cached_columns = None
+        logger.info(
+            'Initialized factory with %s root files, staged on demand',
+            len(self.rootfiles)
+            )
+
+    def _init_skims(self):
+        if self.rootfiles:
+            raise ValueError('Cannot mix skim files and root files in one EventFactory')
+        self.skims = [ SkimFile(f) for f in self.skimfiles ]
+        self._skim_offsets = np.cumsum([0] + [ len(s) for s in self.skims ])
+        self.n_events = int(self._skim_offsets[-1])
+        self.tree = None
+        self.cached_columns = None
+        logger.info(
+            'Initialized factory with %s skim files, %s events',
+            len(self.skimfiles), self.n_events
+            )
+
+    @property
+    def inputfiles(self):
+        return self.skimfiles if self.skims is not None else self.rootfiles
+
+    def select_branches(self, tree, load=True):
+        """
+        Disables all branches in `tree` except self.branches, and configures
+        the TTreeCache for only those branches.
+
+        With load=False no file is opened: the chain applies the branch
+        statuses and the cache size once it loads its first tree, and the
+        cache learns the (enabled) branches over the first entries read.
+        """
+        if self.branches is None:
+            return
+        logger.debug('Reading only branches %s', self.branches)
+        tree.SetBranchStatus('*', 0)
+        for branch in self.branches:
+            tree.SetBranchStatus(branch + '*', 1)
+        if not load:
+            tree.SetCacheSize(self.cache_size)
+            return
+        # The cache needs a loaded tree; TChain carries the branch list over
+        # to the next files
+        if tree.LoadTree(0) < 0:
+            return
+        tree.SetCacheSize(self.cache_size)
+        for branch in self.branches:
+            tree.AddBranchToCache(branch + '*', True)
+        tree.StopCacheLearningPhase()
+
     def __iter__(self):
-        for i_event in range(self.n_events):
-            if i_event == self.max_events: raise StopIteration
-            self.tree.GetEntry(i_event)
-            yield Event(self.tree)
+        # Tracks skipped by Event.get_tracks_columnar are summed over the
+        # iteration and reported once at the end
+        n_skipped = [ 0, 0 ]
+        event = None
+        try:
+            for i_event in self._iter_entries():
+                with instrument.stage('EventFactory.get'):
+                    event = self.get(i_event)
+                yield event
+                instrument.end_event(i_event)
+                _add_skipped_tracks(n_skipped, event)
+                event = None
+        finally:
+            # Also the last event if the loop was broken off
+            _add_skipped_tracks(n_skipped, event)
+            n_at_origin, n_no_vertex = n_skipped
+            if n_at_origin or n_no_vertex:
+                logger.warning(
+                    'Skipped %s tracks pointing to origin and %s tracks with no vertex associated',
+                    n_at_origin, n_no_vertex
+                    )
+
+    def _iter_entries(self):
+        """
+        Yields the global entries to iterate over. Without known entry counts
+        (staging), files are counted as the iteration reaches them, so the
+        first events do not wait for all files to be staged.
+        """
+        if self.n_events is not None:
+            for i_event in range(len(self)):
+                yield i_event
+            return
+        i_event = 0
+        for i_file in range(len(self.rootfiles)):
+            for _ in range(self._get_staged_n_entries(i_file)):
+                if self.max_events is not None and i_event >= self.max_events:
+                    return
+                yield i_event
+                i_event += 1
 
     def get(self, i):
-        self.tree.GetEntry(i)
-        return Event(self.tree)
+        if self.skims is not None:
+            i_file = np.searchsorted(self._skim_offsets, i, side='right') - 1
+            skim = self.skims[i_file]
+            i_local = i - self._skim_offsets[i_file]
+            source, entry = skim.get_source(i_local)
+            return Event(None, entry=entry, arrays=skim.get(i_local), source=source)
+        if self.cached_columns is None:
+            if self.staging is not None:
+                tree, entry = self.get_staged_tree(i)
+                with instrument.stage('TChain.LoadTree'):
+                    tree.LoadTree(entry)
+                # The tree reads the staged copy; the source is the remote file
+                return Event(tree, entry=entry, source=self.rootfiles[self._staged_file_index])
+            # Only the file is loaded here; Event reads the branches it needs
+            with instrument.stage('TChain.LoadTree'):
+                self.tree.LoadTree(i)
+            return Event(self.tree, entry=i)
+        return Event(self.tree, entry=i, columnar=self.get_cached_columnar(i))
+
+    def get_staged_tree(self, i):
+        """
+        Returns (tree, local entry) for global entry i, with the tree reading
+        the staged copy of its root file. Moving on to a new file releases the
+        previous one and starts prefetching the files after it.
+        """
+        i_file, entry = self._find_staged_entry(i)
+        if i_file != self._staged_file_index:
+            self._load_staged_file(i_file)
+        return self._staged_tree, entry
+
+    def _find_staged_entry(self, i):
+        """
+        Returns (file index, local entry) of global entry i, staging files
+        up to the one i is in if their entry counts are not known yet
+        """
+        i_file = self._staged_file_index
+        begin = self._staged_begin
+        if begin is not None and begin <= i < begin + self._staged_n_entries[i_file]:
+            return i_file, i - begin
+        begin = 0
+        for i_file in range(len(self.rootfiles)):
+            n_entries = self._get_staged_n_entries(i_file)
+            if i < begin + n_entries:
+                return i_file, i - begin
+            begin += n_entries
+        raise IndexError('Entry {0} is out of range ({1} events)'.format(i, begin))
+
+    def _get_staged_n_entries(self, i_file):
+        if self._staged_n_entries[i_file] is None:
+            self._load_staged_file(i_file)
+        return self._staged_n_entries[i_file]
+
+    def _load_staged_file(self, i_file):
+        """
+        Stages file i_file and opens a chain on the local copy
+        """
+        if self._staged_file_index is not None:
+            self.staging.release(self.rootfiles[self._staged_file_index])
+        local_path = self.staging.stage(self.rootfiles[i_file])
+        for rootfile in self.rootfiles[i_file+1 : i_file+1+self.staging.n_prefetch]:
+            self.staging.prefetch(rootfile)
+        tree = ROOT.TChain('Events')
+        tree.Add(local_path)
+        self._staged_n_entries[i_file] = int(tree.GetEntries())
+        self.select_branches(tree)
+        self._staged_tree = tree
+        self._staged_file_index = i_file
+        previous = self._staged_n_entries[:i_file]
+        self._staged_begin = None if None in previous else sum(previous)
+        if not None in self._staged_n_entries:
+            self.n_events = sum(self._staged_n_entries)
+
+    def get_cached_columnar(self, i):
+        """
+        Returns the cached (hits, tracks) columnar arrays of global entry i
+        """
+        i_file = np.searchsorted(self._cached_offsets, i, side='right') - 1
+        return self.cached_columns[i_file].get(i - self._cached_offsets[i_file])
 
     def __len__(self):
+        if self.n_events is None:
+            # Staging: counting all entries stages all files
+            for i_file in range(len(self.rootfiles)):
+                self._get_staged_n_entries(i_file)
         return self.n_events if (self.max_events is None) else min(self.n_events, self.max_events)
 
+    def dump_content(self, stream, fmt='text', max_rows=None):
+        """
+        Writes the tracks and hits of all events to `stream` as one table
+        (see Event.dump_content), stopping after `max_rows` rows
+        """
+        writer = utils.TableWriter(stream, CONTENT_COLUMNS, fmt=fmt, max_rows=max_rows)
+        for event in self:
+            event.dump_content(writer)
+            if writer.is_full:
+                break
+        stream.flush()
+        logger.info('Wrote %s rows', writer.n_rows)
+
+    def file_entry_offsets(self):
+        """
+        Returns a list of len(self.inputfiles)+1 global entry numbers; the events
+        of input file i are entries offsets[i] up to offsets[i+1]
+        """
+        if self.skims is not None:
+            return self._skim_offsets.tolist()
+        if self.cached_columns is not None:
+            return self._cached_offsets.tolist()
+        if self._staged_n_entries is not None:
+            return np.cumsum([0] + [
+                self._get_staged_n_entries(i_file) for i_file in range(len(self.rootfiles))
+                ]).tolist()
+        tree_offsets = self.tree.GetTreeOffset()
+        return [ int(tree_offsets[i]) for i in range(len(self.rootfiles)+1) ]
+
+    def get_columnar(self, backend='rdf', n_threads=0):
+        """
+        Returns (hits, hit_offsets, tracks, track_offsets) for all events: the
+        outputs of Event.get_hits_columnar and Event.get_tracks_columnar (with
+        default arguments) concatenated, with the rows of event i at
+        hits[hit_offsets[i]:hit_offsets[i+1]] and likewise for the tracks.
+
+        `backend`: 'rdf' for compiled, multithreaded extraction with
+            RDataFrame (see hgcalhistory.rdf), or 'python' to loop over the
+            events (served from the columnar cache if there is one)
+        """
+        if backend == 'rdf':
+            if self.skims is not None:
+                raise ValueError('The rdf backend cannot read skim files')
+            import rdf
+            return rdf.get_columnar(self.rootfiles, max_events=self.max_events, n_threads=n_threads)
+        elif backend != 'python':
+            raise ValueError('Unknown backend {0}'.format(backend))
+        hits = []
+        tracks = []
+        for event in self:
+            hits.append(event.get_hits_columnar())
+            tracks.append(event.get_tracks_columnar())
+        columnar = []
+        for arrays in [ hits, tracks ]:
+            offsets = np.zeros(len(arrays)+1, dtype=np.int64)
+            offsets[1:] = np.cumsum([ len(a) for a in arrays ])
+            columnar.append(np.concatenate(arrays) if len(arrays) else np.zeros((0, 9)))
+            columnar.append(offsets)
+        return tuple(columnar)
+
+    def select(self, predicate=None, summary_index=None, **requirements):
+        """
+        Iterates over only the events that pass, using the per-event summaries
+        of hgcalhistory.summary (built once per root file on first use).
+        Arguments are as in hgcalhistory.summary.Summary.match, e.g.
+        `factory.select(has_photon=True, min_n_hits_EE=1)`.
+        """
+        if summary_index is None: summary_index = SummaryIndex()
+        offsets = self.file_entry_offsets()
+        n_events = len(self)
+        for rootfile, begin in zip(self.inputfiles, offsets[:-1]):
+            if begin >= n_events: break
+            summary = summary_index.load(rootfile)
+            entries = np.nonzero(summary.match(predicate, **requirements))[0] + begin
+            logger.info('%s: %s of %s events selected', rootfile, len(entries), len(summary))
+            for i in entries[entries < n_events].tolist():
+                yield self.get(i)
+
+    def write_skim(self, path, events=None):
+        """
+        Writes `events` (default: all events of this factory; pass e.g.
+        self.select(...) for a selection) to the skim file `path`, with only
+        the HGCAL hits, the tracks and the vertices. Returns the number of
+        events written.
+        """
+        return write_skim(self if events is None else events, path)
+
+    def map(self, func, n_workers=None, chunk_size=None):
+        """
+        Calls `func(event)` for every event on a pool of `n_workers` processes
+        (default: the number of cores), and returns the results in event order.
+
+        By default every root file is one task; pass `chunk_size` to split the
+        work in tasks of at most that many events instead. Every task opens its
+        own chain on only the file it needs.
+        `func` needs to be picklable, i.e. a module-level function.
+        """
+        import multiprocessing
+        worker_kwargs = dict(self.kwargs, max_events=None)
+        n_events = len(self)
+        offsets = self.file_entry_offsets()
+        tasks = []
+        for rootfile, begin, end in zip(self.inputfiles, offsets[:-1], offsets[1:]):
+            end = min(end, n_events)
+            step = (end - begin) if chunk_size is None else chunk_size
+            for first in range(begin, end, max(step, 1)):
+                last = min(first + step, end)
+                tasks.append((func, rootfile, worker_kwargs, first - begin, last - begin))
+        logger.info(
+            'Processing %s events in %s tasks on %s workers',
+            n_events, len(tasks), n_workers or multiprocessing.cpu_count()
+            )
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            results = pool.map(_map_worker, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return [ r for task_results in results for r in task_results ]
+
+
+def _add_skipped_tracks(n_skipped, event):
+    if event is not None and event.n_skipped_tracks is not None:
+        n_skipped[0] += event.n_skipped_tracks[0]
+        n_skipped[1] += event.n_skipped_tracks[1]
+
+
+def _map_worker(task):
+    """
+    Runs one EventFactory.map task; needs to be module-level to be picklable
+    """
+    func, rootfile, kwargs, first, last = task
+    factory = EventFactory(rootfile, **kwargs)
+    return [ func(factory.get(i)) for i in range(first, last) ]
+
 
 
 class Event(object):
-    def __init__(self, rootevent):
+    """
+    Wraps one entry of the Events tree.
+    The collections (tracks, vertexs, calohits and their array versions) are
+    only read on first access, branch by branch, so cheap checks like
+    has_photon() don't pay for the collections they don't touch.
+    """
+    def __init__(self, rootevent, entry=None, columnar=None, arrays=None, source=None):
+        """
+        `entry` defaults to the entry currently loaded in rootevent.
+        `columnar` optionally passes the precomputed (hits, tracks) columnar
+        arrays, e.g. from a hgcalhistory.cache.ColumnarCache
+        `arrays` optionally passes the (hits, tracks, vertices) arrays, e.g.
+        from a skim file; rootevent can then be None, in which case only the
+        array based methods are available.
+        `source` is the file the event came from, if not the file of rootevent
+        """
         super(Event, self).__init__()
         self.rootevent = rootevent
-        
-        self.tracks = []
-        for t in self.rootevent.SimTracks_g4SimHits__SIM.product():
-            t.__class__ = hgcalhistory.Track
-            self.tracks.append(t)
-
-        self.vertexs = []
-        for v in self.rootevent.SimVertexs_g4SimHits__SIM.product():
-            v.__class__ = hgcalhistory.Vertex
-            self.vertexs.append(v)
-
-        self.calohits = []
-        for h in self.rootevent.PCaloHitWithPositions_PCaloHitWithPositionProducer__SIM.product():
-            # Skip any non-HGCAL hits
-            if not(h.inEE_ or h.inHsi_ or h.inHsc_):
-                continue
-            h.__class__ = hgcalhistory.CaloHitWithPosition
-            self.calohits.append(h)
+        self.entry = rootevent.GetReadEntry() if entry is None else entry
+        self.source = source
+        self._columnar = columnar
 
-        self.n_tracks = len(self.tracks)
-        self.n_vertexs = len(self.vertexs)
+        self._tracks = None
+        self._vertexs = None
+        self._calohits = None
 
         self._tracks_position_collection = None
         self._vertexs_position_collection = None
 
+        self._track_index_map = None
+        self._vertex_index_map = None
+
+        self._hit_arrays = None
+        self._track_arrays = None
+        self._vertex_arrays = None
+        self._history = None
+        # (pointing to origin, no vertex) tracks skipped by get_tracks_columnar
+        self.n_skipped_tracks = None
+        if arrays is not None:
+            self._hit_arrays, self._track_arrays, self._vertex_arrays = arrays
+
+    def _get_product(self, branch):
+        """
+        Returns the product of `branch` for this event. Only this branch is
+        read, and only if it does not hold this entry already (e.g. because
+        the tree has moved on since this Event was created).
+        """
+        if self.rootevent is None:
+            raise ValueError(
+                'Event {0} is only backed by arrays (e.g. read from a skim); '
+                'use the array methods instead of {1}'.format(self.entry, branch)
+                )
+        local_entry = self.rootevent.LoadTree(self.entry)
+        tbranch = self.rootevent.GetBranch(branch) or self.rootevent.GetBranch(branch + '.')
+        if not tbranch:
+            raise ValueError('Branch {0} not found in the tree'.format(branch))
+        if tbranch.GetReadEntry() != local_entry:
+            with instrument.stage('TBranch.GetEntry'):
+                tbranch.GetEntry(local_entry)
+        return getattr(self.rootevent, branch).product()
+
+    @property
+    def tracks(self):
+        if self._tracks is None:
+            self._tracks = []
+            for t in self._get_product(TRACKS_BRANCH):
+                t.__class__ = hgcalhistory.Track
+                self._tracks.append(t)
+        return self._tracks
+
+    @property
+    def vertexs(self):
+        if self._vertexs is None:
+            self._vertexs = []
+            for v in self._get_product(VERTEXS_BRANCH):
+                v.__class__ = hgcalhistory.Vertex
+                self._vertexs.append(v)
+        return self._vertexs
+
+    @property
+    def calohits(self):
+        if self._calohits is None:
+            self._calohits = []
+            for h in self._get_product(CALOHITS_BRANCH):
+                # Skip any non-HGCAL hits
+                if not(h.inEE_ or h.inHsi_ or h.inHsc_):
+                    continue
+                h.__class__ = hgcalhistory.CaloHitWithPosition
+                self._calohits.append(h)
+        return self._calohits
+
+    @property
+    def n_tracks(self):
+        if self._track_arrays is not None:
+            return len(self._track_arrays['id'])
+        return self._get_product(TRACKS_BRANCH).size()
+
+    @property
+    def n_vertexs(self):
+        if self._vertex_arrays is not None:
+            return len(self._vertex_arrays['id'])
+        return self._get_product(VERTEXS_BRANCH).size()
 
     def has_photon(self):
-        for track in self.tracks:
-            if track.pdgid() == 22:
-                return True
-        else:
-            return False
+        return bool(np.any(self.get_track_arrays()['pdgid'] == 22))
 
     def has_calohits_inEE(self):
-        for hit in self.calohits:
-            if hit.inEE_:
-                return True
-        else:
-            return False
+        return bool(np.any(self.get_hit_arrays()['inEE']))
+
+    @property
+    def history(self):
+        """
+        hgcalhistory.history.History of this event: primary ancestor and
+        generation of every track and hit, and subtree queries; built once
+        """
+        if self._history is None:
+            with instrument.stage('Event.history'):
+                self._history = History(
+                    self.get_track_arrays(), self.get_vertex_arrays(), self.get_hit_arrays()
+                    )
+        return self._history
+
+    @staticmethod
+    def _build_index_map(ids):
+        """
+        Returns a dict id -> index into `ids`.
+        For duplicate ids the first occurrence wins.
+        """
+        index_map = {}
+        for i, id in enumerate(ids.tolist()):
+            index_map.setdefault(id, i)
+        return index_map
+
+    @property
+    def track_index_map(self):
+        """
+        Maps track id -> index in self.tracks; built once per event
+        """
+        if self._track_index_map is None:
+            self._track_index_map = self._build_index_map(self.get_track_arrays()['id'])
+        return self._track_index_map
+
+    @property
+    def vertex_index_map(self):
+        """
+        Maps vertex id -> index in self.vertexs; built once per event
+        """
+        if self._vertex_index_map is None:
+            self._vertex_index_map = self._build_index_map(self.get_vertex_arrays()['id'])
+        return self._vertex_index_map
 
     def get_vertex_by_id(self, id):
-        for v in self.vertexs:
-            if v.id() == id:
-                return v
-        else:
+        index = self.vertex_index_map.get(id, None)
+        if index is None:
             return None
+        return self.vertexs[index]
 
     def get_track_by_id(self, id):
-        for v in self.tracks:
-            if v.id() == id:
-                return v
-        else:
+        index = self.track_index_map.get(id, None)
+        if index is None:
             raise ValueError(
                 'Track id {0}: no such track in event. Available track ids: {1}'
                 .format(id, [v.id() for v in self.tracks])
                 )
+        return self.tracks[index]
 
     def get_vertex_for_track(self, track):
         vertex_index = track.vertex_index()
@@ -124,9 +621,10 @@ class Event(object):
     def _get_tracks_position_collection(self):
         if not(self._tracks_position_collection is None):
             return self._tracks_position_collection
-        self._tracks_position_collection = PositionCollection()
-        for t in self.tracks:
-            self._tracks_position_collection.add(*t.xyz())
+        tracks = self.get_track_arrays()
+        self._tracks_position_collection = PositionCollection.from_arrays(
+            tracks['x'], tracks['y'], tracks['z']
+            )
         return self._tracks_position_collection
 
     track_positions = property(_get_tracks_position_collection)
@@ -134,235 +632,322 @@ class Event(object):
     def _get_vertexs_position_collection(self):
         if not(self._vertexs_position_collection is None):
             return self._vertexs_position_collection
-        self._vertexs_position_collection = PositionCollection()
-        for v in self.vertexs:
-            self._vertexs_position_collection.add(*v.xyz())
+        vertexs = self.get_vertex_arrays()
+        self._vertexs_position_collection = PositionCollection.from_arrays(
+            vertexs['x'], vertexs['y'], vertexs['z']
+            )
         return self._vertexs_position_collection
 
     vertex_positions = property(_get_vertexs_position_collection)
 
-    def debug_content_dump(self):
-        for track in self.tracks:
-            vertex = self.get_vertex_for_track(track)
-            if vertex is None:
-                logger.info('%s has no vertex', track)
-                continue
-            if vertex.track_id() != -1:
-                track_for_vertex = self.get_track_by_id(vertex.track_id())
-                if not track_for_vertex is None:
-                    logger.debug(
-                        '%s  <<  Vertex %s  <<  Track %s',
-                        track, vertex, track_for_vertex.id()
-                        )
-                else:
-                    logger.debug(
-                        '%s  <<  Vertex %s  <<  Track %s (does not exist)',
-                        track, vertex, vertex.track_id()
-                        )
-            else:
-                logger.debug(
-                    '%s  <<  Vertex %s (no parent track)',
-                    track, vertex
-                    )
-
-        for hit in self.calohits:
-
-            volume = 'Uns'
-            if hit.inEE_:
-                volume = 'EE '
-            elif hit.inHsc_:
-                volume = 'Hsc'
-            elif hit.inHsi_:
-                volume = 'Hsi'
-            else:
-                logger.warning('Hit %s has no HGCAL volume', hit.id())
-
-            track_id = hit.track_id()
-            if track_id == 0:
-                logger.debug('Hit %s (%s) has track id 0 (no such track)', hit.id(), volume)
-            else:
-                try:
-                    track = self.get_track_by_id(track_id)
-                    logger.debug(
-                        'Hit %s (%s) has track id %s which is pdgid %s',
-                        hit.id(), volume, track_id, track.pdgid()
-                        )
-                except ValueError:
-                    logger.debug(
-                        'Hit %s (%s) has track id %s which does not exist',
-                        hit.id(), volume, track_id
-                        )
-
+    def dump_content(self, writer):
+        """
+        Writes one row per track and per HGCAL hit to `writer`, a
+        hgcalhistory.utils.TableWriter with columns CONTENT_COLUMNS. Rows are
+        built from the column arrays, and only as many as the writer still
+        accepts.
+        """
+        rows_left = writer.rows_left
+
+        tracks = bulk.select(self.get_track_arrays(), slice(rows_left))
+        vertexs = self.get_vertex_arrays()
+        n_tracks = len(tracks['id'])
+        vertex_index = tracks['vertex_index']
+        has_vertex = (vertex_index >= 0) & (vertex_index < len(vertexs['id']))
+        vertex_ids = np.full(n_tracks, -1, dtype=np.int64)
+        vertex_ids[has_vertex] = vertexs['id'][vertex_index[has_vertex]]
+        parent_track_ids = np.full(n_tracks, -1, dtype=np.int64)
+        parent_track_ids[has_vertex] = vertexs['track_id'][vertex_index[has_vertex]]
+        writer.write_rows(zip(
+            [ self.entry ] * n_tracks,
+            [ 'track' ] * n_tracks,
+            tracks['id'].tolist(),
+            [ '' ] * n_tracks,
+            tracks['pdgid'].tolist(),
+            tracks['energy'].tolist(),
+            tracks['x'].tolist(),
+            tracks['y'].tolist(),
+            tracks['z'].tolist(),
+            tracks['id'].tolist(),
+            vertex_ids.tolist(),
+            parent_track_ids.tolist(),
+            ))
+        if writer.is_full:
+            return
+
+        hits = bulk.select(self.get_hit_arrays(), slice(writer.rows_left))
+        n_hits = len(hits['id'])
+        volumes = np.select(
+            [ hits['inEE'], hits['inHsc'], hits['inHsi'] ], [ 'EE', 'Hsc', 'Hsi' ], default='Uns'
+            )
+        all_tracks = self.get_track_arrays()
+        pdgids = bulk.join_by_id(all_tracks['id'], all_tracks['pdgid'], hits['track_id'], default=0)
+        writer.write_rows(zip(
+            [ self.entry ] * n_hits,
+            [ 'hit' ] * n_hits,
+            hits['id'].tolist(),
+            volumes.tolist(),
+            pdgids.tolist(),
+            hits['energy'].tolist(),
+            hits['x'].tolist(),
+            hits['y'].tolist(),
+            hits['z'].tolist(),
+            hits['track_id'].tolist(),
+            [ -1 ] * n_hits,
+            [ -1 ] * n_hits,
+            ))
+
+    def debug_content_dump(self, stream=None, fmt='text', max_rows=None, level=logging.DEBUG):
+        """
+        Dumps all tracks and HGCAL hits as a table (see dump_content).
+        Without `stream` the table goes to the logger at `level`, and nothing
+        is computed if that level is disabled. `fmt` is 'text', 'csv' or
+        'jsonl'; `max_rows` caps the number of rows.
+        """
+        if stream is None:
+            if not logger.isEnabledFor(level):
+                return
+            stream = utils.LoggerStream(logger, level)
+        writer = utils.TableWriter(stream, CONTENT_COLUMNS, fmt=fmt, max_rows=max_rows)
+        self.dump_content(writer)
+        stream.flush()
+
+    @timed('Event.get_tracks_columnar')
     def get_tracks_columnar(self, only_in_hgcal=True, filter_zero_tracks=True):
         """
-        Returns the tracks in the event as columnar data
-        Currently there are 8 columns. See the first lists in the code, below:        
-        """
-        track_x = []
-        track_y = []
-        track_z = []
-        vertex_x = []
-        vertex_y = []
-        vertex_z = []
-        pdgids = []
-        track_ids = []
-        vertex_ids = []
-
-        for track in self.tracks:
-            x_t, y_t, z_t = track.xyz()
-
-            if filter_zero_tracks and x_t == 0. and y_t == 0. and z_t == 0.:
-                logger.warning('Skipping %s ; points to origin', track)
-                continue
-
-            vertex = self.get_vertex_for_track(track)
-            if vertex is None:
-                logger.warning('Skipping track %s, no vertex associated', track)
-                continue
-
-            # logger.debug('%s --> %s', track, vertex)
-
-            x_v, y_v, z_v = vertex.xyz()
-
-            # Skip if not in hgcal
-            if only_in_hgcal:
-                if z_t > 0. and (
-                    z_t < hgcal_zmin_pos and z_v < hgcal_zmin_pos
-                    or z_t > hgcal_zmax_pos and z_v > hgcal_zmax_pos
-                    ):
-                    continue
-                elif z_t < 0. and (
-                    z_t < hgcal_zmin_neg and z_v < hgcal_zmin_neg
-                    or z_t > hgcal_zmax_neg and z_v > hgcal_zmax_neg
-                    ):
-                    continue
+        Returns the tracks in the event as columnar data, with 9 columns:
+        track x, y, z, vertex x, y, z, pdgid, track id, vertex id.
+        Tracks without a vertex are skipped; tracks pointing to the origin are
+        skipped if `filter_zero_tracks`. If `only_in_hgcal`, tracks whose track
+        and vertex z are both on the same side outside the HGCAL z window are
+        skipped.
+        """
+        if self._columnar is not None and only_in_hgcal and filter_zero_tracks:
+            return np.array(self._columnar[1])
+        tracks = self.get_track_arrays()
+        vertexs = self.get_vertex_arrays()
+        x_t, y_t, z_t = tracks['x'], tracks['y'], tracks['z']
+
+        keep = np.ones(len(x_t), dtype=bool)
+        if filter_zero_tracks:
+            keep &= ~((x_t == 0.) & (y_t == 0.) & (z_t == 0.))
+        n_at_origin = len(x_t) - np.count_nonzero(keep)
+
+        # Join the vertex for each track by index
+        vertex_index = tracks['vertex_index']
+        has_vertex = (vertex_index >= 0) & (vertex_index < len(vertexs['id']))
+        n_no_vertex = np.count_nonzero(keep & ~has_vertex)
+        keep &= has_vertex
+        vertexs = bulk.select(vertexs, vertex_index[keep])
+        tracks = bulk.select(tracks, keep)
+        z_t = tracks['z']
+        z_v = vertexs['z']
+
+        self.n_skipped_tracks = (n_at_origin, n_no_vertex)
+        if n_at_origin or n_no_vertex:
+            logger.debug(
+                'Event %s: skipped %s tracks pointing to origin and %s tracks with no vertex associated',
+                self.entry, n_at_origin, n_no_vertex
+                )
 
-            track_x.append(x_t)
-            track_y.append(y_t)
-            track_z.append(z_t)
-            vertex_x.append(x_v)
-            vertex_y.append(y_v)
-            vertex_z.append(z_v)
-            pdgids.append(track.pdgid())
-            track_ids.append(track.id())
-            vertex_ids.append(vertex.id())
-
-        columns = np.stack(
-            (
-                np.array(track_x),
-                np.array(track_y),
-                np.array(track_z),
-                np.array(vertex_x),
-                np.array(vertex_y),
-                np.array(vertex_z),
-                np.array(pdgids),
-                np.array(track_ids),
-                np.array(vertex_ids)
+        # Skip if not in hgcal
+        if only_in_hgcal:
+            outside_pos = (z_t > 0.) & (
+                ((z_t < hgcal_zmin_pos) & (z_v < hgcal_zmin_pos))
+                | ((z_t > hgcal_zmax_pos) & (z_v > hgcal_zmax_pos))
                 )
-            ).T
-        assert columns.shape == (len(track_x), 9)
+            outside_neg = (z_t < 0.) & (
+                ((z_t < hgcal_zmin_neg) & (z_v < hgcal_zmin_neg))
+                | ((z_t > hgcal_zmax_neg) & (z_v > hgcal_zmax_neg))
+                )
+            crosses_hgcal = ~(outside_pos | outside_neg)
+            tracks = bulk.select(tracks, crosses_hgcal)
+            vertexs = bulk.select(vertexs, crosses_hgcal)
+
+        columns = np.column_stack((
+            tracks['x'],
+            tracks['y'],
+            tracks['z'],
+            vertexs['x'],
+            vertexs['y'],
+            vertexs['z'],
+            tracks['pdgid'],
+            tracks['id'],
+            vertexs['id'],
+            )).astype(np.float64)
+        assert columns.shape == (len(tracks['x']), 9)
         return columns
 
-    def get_hits_columnar(self, only_in_hgcal=True):
-        xs = []
-        ys = []
-        zs = []
-        layers = []
-        times = []
-        energies = []
-        track_ids = []
-        which_detector = []
-        pdgids = []
-        for hit in self.calohits:
-            x, y, z = hit.xyz()
-
-            # Skip if not in hgcal
-            if only_in_hgcal and not hgcalhistory.physutils.in_hgcal(z):
-                continue
-
-            xs.append(x)
-            ys.append(y)
-            zs.append(z)
-            layers.append(hit.layer_)
-            times.append(hit.time())
-            energies.append(hit.energy())
-            track_id = hit.geantTrackId()
-            track_ids.append(track_id)
-
-            if hit.inEE_:
-                det = 1
-            elif hit.inHsi_:
-                det = 2
-            elif hit.inHsc_:
-                det = 3
-            else:
-                det = 0
-            which_detector.append(det)
-
-            # expensive loop
-            for t in self.tracks:
-                if t.id() == track_id:
-                    pdgid = t.pdgid()
-                    break
-            else:
-                pdgid = 0
-            pdgids.append(pdgid)
-
-        columns = np.stack(
-            (
-                np.array(xs),
-                np.array(ys),
-                np.array(zs),
-                np.array(layers),
-                np.array(times),
-                np.array(energies),
-                np.array(track_ids),
-                np.array(which_detector),
-                np.array(pdgids)
+    @timed('Event.get_hit_arrays')
+    def get_hit_arrays(self):
+        """
+        Returns the HGCAL calo hits of the event as a dict of numpy arrays
+        (keys: hgcalhistory.bulk.HIT_FIELDS), read in one bulk call
+        """
+        if self._hit_arrays is None:
+            hits = bulk.read_hits(
+                self._get_product(CALOHITS_BRANCH)
                 )
-            ).T
-        assert columns.shape == (len(xs), 9)
+            # Skip any non-HGCAL hits
+            self._hit_arrays = bulk.select(hits, hits['inEE'] | hits['inHsi'] | hits['inHsc'])
+        return self._hit_arrays
+
+    @timed('Event.get_track_arrays')
+    def get_track_arrays(self):
+        """
+        Returns the tracks of the event as a dict of numpy arrays
+        (keys: hgcalhistory.bulk.TRACK_FIELDS), read in one bulk call
+        """
+        if self._track_arrays is None:
+            self._track_arrays = bulk.read_tracks(self._get_product(TRACKS_BRANCH))
+        return self._track_arrays
+
+    @timed('Event.get_vertex_arrays')
+    def get_vertex_arrays(self):
+        """
+        Returns the vertices of the event as a dict of numpy arrays
+        (keys: hgcalhistory.bulk.VERTEX_FIELDS), read in one bulk call
+        """
+        if self._vertex_arrays is None:
+            self._vertex_arrays = bulk.read_vertices(self._get_product(VERTEXS_BRANCH))
+        return self._vertex_arrays
+
+    @timed('Event.get_hits_columnar')
+    def get_hits_columnar(self, only_in_hgcal=True):
+        """
+        Returns the HGCAL hits in the event as columnar data, with columns
+        x, y, z, layer, time, energy, track_id, which_detector, pdgid.
+        which_detector is 1 for EE, 2 for Hsi, 3 for Hsc.
+        pdgid is 0 if the track of the hit is not in the event.
+        """
+        if self._columnar is not None and only_in_hgcal:
+            return np.array(self._columnar[0])
+        hits = self.get_hit_arrays()
+        if only_in_hgcal:
+            hits = bulk.select(hits, in_hgcal(hits['z']))
+        which_detector = np.select(
+            [ hits['inEE'], hits['inHsi'], hits['inHsc'] ], [ 1, 2, 3 ], default=0
+            )
+        tracks = self.get_track_arrays()
+        pdgids = bulk.join_by_id(tracks['id'], tracks['pdgid'], hits['track_id'], default=0)
+        columns = np.column_stack((
+            hits['x'],
+            hits['y'],
+            hits['z'],
+            hits['layer'],
+            hits['time'],
+            hits['energy'],
+            hits['track_id'],
+            which_detector,
+            pdgids,
+            )).astype(np.float64)
+        assert columns.shape == (len(hits['x']), 9)
         return columns
 
 
 class PositionCollection(object):
-    """docstring for PositionCollection"""
-    def __init__(self):
+    """
+    Collection of (x, y, z) positions, stored in one contiguous Nx3 float32
+    buffer that grows by doubling. The bounds are updated as positions are
+    added, and the buffer is passed to ROOT as is.
+    """
+    def __init__(self, capacity=64):
         super(PositionCollection, self).__init__()
-        self.x = []
-        self.y = []
-        self.z = []
-        self.concat = []
-    
+        self._buffer = np.empty((max(capacity, 1), 3), dtype=np.float32)
+        self.n = 0
+        self._min = np.full(3, np.inf)
+        self._max = np.full(3, -np.inf)
+
+    @classmethod
+    def from_arrays(cls, x, y, z):
+        collection = cls(capacity=len(x))
+        collection.extend(np.column_stack((x, y, z)))
+        return collection
+
+    def _reserve(self, n):
+        if n <= len(self._buffer):
+            return
+        buffer = np.empty((max(n, 2*len(self._buffer)), 3), dtype=np.float32)
+        buffer[:self.n] = self._buffer[:self.n]
+        self._buffer = buffer
+
     def add(self, x, y, z):
-        self.x.append(x)
-        self.y.append(y)
-        self.z.append(z)
-        self.concat.extend([x, y, z])
+        self._reserve(self.n + 1)
+        self._buffer[self.n] = (x, y, z)
+        self.n += 1
+        self._min = np.minimum(self._min, (x, y, z))
+        self._max = np.maximum(self._max, (x, y, z))
+
+    def extend(self, positions):
+        """
+        Adds an Nx3 array of positions
+        """
+        positions = np.asarray(positions).reshape((-1, 3))
+        if len(positions) == 0:
+            return
+        self._reserve(self.n + len(positions))
+        self._buffer[self.n:self.n+len(positions)] = positions
+        self.n += len(positions)
+        self._min = np.minimum(self._min, positions.min(axis=0))
+        self._max = np.maximum(self._max, positions.max(axis=0))
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def positions(self):
+        """
+        Nx3 view on the filled part of the buffer
+        """
+        return self._buffer[:self.n]
+
+    @property
+    def x(self):
+        return self.positions[:,0]
+
+    @property
+    def y(self):
+        return self.positions[:,1]
+
+    @property
+    def z(self):
+        return self.positions[:,2]
+
+    @property
+    def concat(self):
+        return self.as_array()
+
+    def _bound(self, bounds, i):
+        if self.n == 0:
+            raise ValueError('PositionCollection is empty')
+        return float(bounds[i])
 
     def xmin(self):
-        return min(self.x)
+        return self._bound(self._min, 0)
     def xmax(self):
-        return max(self.x)
+        return self._bound(self._max, 0)
     def ymin(self):
-        return min(self.y)
+        return self._bound(self._min, 1)
     def ymax(self):
-        return max(self.y)
+        return self._bound(self._max, 1)
     def zmin(self):
-        return min(self.z)
+        return self._bound(self._min, 2)
     def zmax(self):
-        return max(self.z)
+        return self._bound(self._max, 2)
 
     def minmax_xyz(self):
         return self.xmin(), self.ymin(), self.zmin(), \
             self.xmax(), self.ymax(), self.zmax()
 
     def as_array(self):
-        return array('f', self.concat)
+        """
+        Flat x0, y0, z0, x1, ... float32 view on the buffer (no copy)
+        """
+        return self.positions.ravel()
 
     def as_tpolymarker3d(self, marker_style=9):
         r = ROOT.TPolyMarker3D(
-            len(self.x),
+            len(self),
             self.as_array(),
             marker_style
             )
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Ancestry of the tracks and hits in an event.
+
+The chain is track -> vertex (track.vertIndex) -> parent track (the
+vertex.parentIndex track id). History turns that into a parent index per
+track once, resolves the primary ancestor and generation depth of every track
+with pointer jumping, and keeps CSR adjacency arrays (track -> child tracks,
+track -> hits) for subtree queries.
+"""
+from __future__ import print_function
+import logging
+import numpy as np
+logger = logging.getLogger('hgcalhistory')
+
+from bulk import join_by_id
+
+
+def _gather_ranges(indptr, values, nodes):
+    """
+    Returns the concatenation of values[indptr[i]:indptr[i+1]] for all i in
+    nodes, without a Python loop over nodes
+    """
+    starts = indptr[nodes]
+    lengths = indptr[nodes + 1] - starts
+    total = lengths.sum()
+    if total == 0:
+        return values[:0]
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return values[offsets + np.arange(total)]
+
+
+def _build_csr(keys, n):
+    """
+    Groups the indices of `keys` by key (keys < 0 are dropped).
+    Returns (indptr, indices): the indices with key i are
+    indices[indptr[i]:indptr[i+1]], in their original order
+    """
+    is_valid = keys >= 0
+    order = np.argsort(keys, kind='mergesort')
+    indices = order[is_valid[order]]
+    counts = np.bincount(keys[is_valid], minlength=n)
+    indptr = np.zeros(n+1, dtype=np.int64)
+    indptr[1:] = np.cumsum(counts)
+    return indptr, indices
+
+
+class History(object):
+    """
+    Takes the track, vertex and hit arrays of an event (see
+    Event.get_track_arrays etc.).
+
+    Per track (in the order of the track arrays):
+    `parent`: index of the parent track, -1 if there is none in the event
+    `primary`: index of the primary ancestor (the track itself for primaries)
+    `depth`: number of generations below the primary (0 for primaries)
+
+    Per hit (in the order of the hit arrays):
+    `hit_track`: index of the track of the hit, -1 if it is not in the event
+    """
+
+    def __init__(self, tracks, vertexs, hits):
+        super(History, self).__init__()
+        self.tracks = tracks
+        self.hits = hits
+        track_ids = tracks['id']
+        self.n_tracks = len(track_ids)
+        self.track_indices = np.arange(self.n_tracks)
+
+        vertex_index = tracks['vertex_index']
+        has_vertex = (vertex_index >= 0) & (vertex_index < len(vertexs['id']))
+        parent_track_id = np.full(self.n_tracks, -1, dtype=np.int64)
+        parent_track_id[has_vertex] = vertexs['track_id'][vertex_index[has_vertex]]
+        self.parent = self.get_track_indices(parent_track_id)
+        # A track cannot be its own parent; treat it as a primary
+        self.parent[self.parent == self.track_indices] = -1
+
+        self._resolve_primaries()
+        self.hit_track = self.get_track_indices(hits['track_id'])
+        self.children_indptr, self.children = _build_csr(self.parent, self.n_tracks)
+        self.hits_indptr, self.hits_of_track = _build_csr(self.hit_track, self.n_tracks)
+
+    def get_track_indices(self, track_ids):
+        """
+        Returns the track index for every track id in `track_ids`, -1 if unknown
+        """
+        return join_by_id(
+            self.tracks['id'], self.track_indices, np.asarray(track_ids, dtype=np.int64),
+            default=-1
+            )
+
+    def get_track_index(self, track_id):
+        index = int(self.get_track_indices([ track_id ])[0])
+        if index == -1:
+            raise ValueError(
+                'Track id {0}: no such track in event'.format(track_id)
+                )
+        return index
+
+    def _resolve_primaries(self):
+        """
+        Pointer jumping: every pass doubles the distance each track looks up
+        its ancestry, so this takes O(log(depth)) vectorized passes
+        """
+        has_parent = self.parent >= 0
+        jump = np.where(has_parent, self.parent, self.track_indices)
+        depth = has_parent.astype(np.int64)
+        max_passes = int(np.ceil(np.log2(max(self.n_tracks, 1)))) + 2
+        for _ in range(max_passes):
+            if np.all(self.parent[jump] < 0):
+                break
+            depth = depth + depth[jump]
+            jump = jump[jump]
+        else:
+            raise ValueError('The track ancestry contains a cycle')
+        self.primary = jump
+        self.depth = depth
+
+    def get_hit_ancestry(self):
+        """
+        Returns a dict of per-hit arrays:
+        `primary`: index of the primary track (-1 if the hit's track is unknown)
+        `primary_track_id`: id of the primary track (0 if unknown)
+        `primary_pdgid`: pdgid of the primary track (0 if unknown)
+        `depth`: generation of the hit's track below the primary (-1 if unknown)
+        """
+        is_known = self.hit_track >= 0
+        hit_track = self.hit_track[is_known]
+        n_hits = len(self.hit_track)
+        ancestry = dict(
+            primary = np.full(n_hits, -1, dtype=np.int64),
+            primary_track_id = np.zeros(n_hits, dtype=np.int64),
+            primary_pdgid = np.zeros(n_hits, dtype=np.int64),
+            depth = np.full(n_hits, -1, dtype=np.int64),
+            )
+        primary = self.primary[hit_track]
+        ancestry['primary'][is_known] = primary
+        ancestry['primary_track_id'][is_known] = self.tracks['id'][primary]
+        ancestry['primary_pdgid'][is_known] = self.tracks['pdgid'][primary]
+        ancestry['depth'][is_known] = self.depth[hit_track]
+        return ancestry
+
+    def get_descendants(self, track_id):
+        """
+        Returns the indices of all tracks in the subtree of `track_id`,
+        including the track itself. Costs O(size of the subtree).
+        """
+        frontier = np.array([ self.get_track_index(track_id) ])
+        subtree = [ frontier ]
+        while len(frontier):
+            frontier = _gather_ranges(self.children_indptr, self.children, frontier)
+            subtree.append(frontier)
+        return np.concatenate(subtree)
+
+    def get_descendant_track_ids(self, track_id):
+        return self.tracks['id'][self.get_descendants(track_id)]
+
+    def get_subtree_hits(self, track_id):
+        """
+        Returns the indices of all hits from tracks in the subtree of `track_id`
+        """
+        return _gather_ranges(
+            self.hits_indptr, self.hits_of_track, self.get_descendants(track_id)
+            )
+
+    def get_subtree_energy(self, track_id):
+        """
+        Returns the summed energy of all hits in the subtree of `track_id`
+        """
+        return float(self.hits['energy'][self.get_subtree_hits(track_id)].sum())
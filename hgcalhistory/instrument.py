@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Opt-in timing and memory instrumentation.
+
+Code marks stages with the `stage(name)` context manager or the `timed(name)`
+decorator. Once enabled, every stage accumulates its call count, wall time,
+bytes read by ROOT files (TFile.GetFileBytesRead) and change in resident
+memory. Times are inclusive: a stage includes the stages nested in it.
+`summary()` prints a table at the end of a run; with `enable(trace=path)`
+one json line per event is written with the stages of that event.
+
+Disabled (the default), a stage is a check of a global flag, so the marks can
+stay in the hot paths. Set HGCALHISTORY_INSTRUMENT=1 to enable from the
+environment (and HGCALHISTORY_TRACE=path for the per-event trace); a summary
+is then logged at exit.
+"""
+from __future__ import print_function
+import os, sys, logging, json, functools, atexit
+from timeit import default_timer
+import hgcalhistory
+logger = logging.getLogger('hgcalhistory')
+
+ENABLED = False
+
+# name -> [ calls, wall time, bytes read, rss delta ]
+_STATS = {}
+# Same, only for the current event; written to the trace by end_event
+_EVENT_STATS = {}
+_TRACE = None
+
+SUMMARY_COLUMNS = ( 'stage', 'calls', 'total [s]', 'per call [ms]', 'read [MB]', 'rss [MB]' )
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+
+def get_rss():
+    """
+    Returns the resident memory of this process in bytes (0 if unknown)
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (IOError, OSError):
+        return 0
+
+
+def get_bytes_read():
+    """
+    Returns the total number of bytes read by ROOT files so far (0 if ROOT was
+    never imported; this does not import it)
+    """
+    ROOT = sys.modules.get('ROOT', None)
+    if ROOT is None: return 0
+    return int(ROOT.TFile.GetFileBytesRead())
+
+
+def enable(trace=None):
+    """
+    Starts recording. `trace` is a path (or open stream) for the per-event
+    json lines.
+    """
+    global ENABLED, _TRACE
+    ENABLED = True
+    if trace is not None:
+        _TRACE = open(trace, 'w') if hgcalhistory.utils.is_string(trace) else trace
+    logger.info('Instrumentation enabled')
+
+
+def disable():
+    global ENABLED, _TRACE
+    ENABLED = False
+    if _TRACE is not None:
+        _TRACE.flush()
+        if not _TRACE in (sys.stdout, sys.stderr):
+            _TRACE.close()
+        _TRACE = None
+
+
+def reset():
+    _STATS.clear()
+    _EVENT_STATS.clear()
+
+
+def _add(stats, name, wall, n_bytes, rss):
+    entry = stats.get(name, None)
+    if entry is None:
+        stats[name] = [ 1, wall, n_bytes, rss ]
+    else:
+        entry[0] += 1
+        entry[1] += wall
+        entry[2] += n_bytes
+        entry[3] += rss
+
+
+class _Stage(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._bytes = get_bytes_read()
+        self._rss = get_rss()
+        self._t = default_timer()
+        return self
+
+    def __exit__(self, *args):
+        wall = default_timer() - self._t
+        n_bytes = get_bytes_read() - self._bytes
+        rss = get_rss() - self._rss
+        _add(_STATS, self.name, wall, n_bytes, rss)
+        if _TRACE is not None:
+            _add(_EVENT_STATS, self.name, wall, n_bytes, rss)
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name):
+    """
+    Context manager marking a stage
+    """
+    if not ENABLED: return _NULL_STAGE
+    return _Stage(name)
+
+
+def timed(name):
+    """
+    Decorator marking every call of a function as a stage
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with _Stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def end_event(entry):
+    """
+    Writes the stages recorded since the last end_event as one trace line
+    """
+    if _TRACE is None: return
+    _TRACE.write(json.dumps(dict(
+        entry = entry,
+        rss = get_rss(),
+        stages = {
+            name : dict(calls=calls, wall=wall, bytes_read=n_bytes, rss_delta=rss)
+            for name, (calls, wall, n_bytes, rss) in _EVENT_STATS.items()
+            },
+        )) + '\n')
+    _EVENT_STATS.clear()
+
+
+def get_stats():
+    """
+    Returns a dict stage name -> dict(calls, wall, bytes_read, rss_delta)
+    """
+    return {
+        name : dict(calls=calls, wall=wall, bytes_read=n_bytes, rss_delta=rss)
+        for name, (calls, wall, n_bytes, rss) in _STATS.items()
+        }
+
+
+def summary(stream=None):
+    """
+    Writes a table of all stages, slowest first, to stream (default: the
+    logger)
+    """
+    to_logger = stream is None
+    if to_logger: stream = hgcalhistory.utils.LoggerStream(logger, logging.INFO)
+    writer = hgcalhistory.utils.TableWriter(stream, SUMMARY_COLUMNS, width=28)
+    rows = sorted(_STATS.items(), key=lambda item: -item[1][1])
+    writer.write_rows(
+        (name, calls, wall, 1e3 * wall / calls, n_bytes / 1e6, rss / 1e6)
+        for name, (calls, wall, n_bytes, rss) in rows
+        )
+    stream.flush()
+
+
+def _enable_from_environment():
+    if not os.environ.get('HGCALHISTORY_INSTRUMENT', ''): return
+    enable(trace=os.environ.get('HGCALHISTORY_TRACE', None))
+    @atexit.register
+    def _summary_at_exit():
+        summary()
+        disable()
+
+_enable_from_environment()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Deferred import of ROOT.
+
+Modules use `from lazyroot import ROOT` instead of `import ROOT`. The proxy
+imports and configures ROOT (batch mode, error level, no stat boxes, FWLite)
+on the first attribute access, so the parts of hgcalhistory that do not need
+ROOT import quickly and work without it.
+"""
+import logging
+logger = logging.getLogger('hgcalhistory')
+
+_ROOT = None
+
+
+def load():
+    """
+    Imports and configures ROOT; only does work on the first call
+    """
+    global _ROOT
+    if _ROOT is not None:
+        return _ROOT
+    logger.debug('Importing ROOT')
+    import ROOT
+    ROOT.gROOT.SetBatch(True)
+    ROOT.gROOT.ProcessLine("gErrorIgnoreLevel = kError;")
+    ROOT.gStyle.SetOptStat(0)
+    if ROOT.gSystem.Load('libFWCoreFWLite') < 0:
+        logger.warning('Could not load libFWCoreFWLite; EDM collections will not be readable')
+    else:
+        ROOT.FWLiteEnabler.enable()
+    _ROOT = ROOT
+    return _ROOT
+
+
+def is_loaded():
+    return _ROOT is not None
+
+
+class _LazyROOT(object):
+    """
+    Stands in for the ROOT module; loads it on first attribute access
+    """
+    def __getattr__(self, name):
+        return getattr(load(), name)
+
+    def __repr__(self):
+        return '<lazy ROOT ({0})>'.format('loaded' if is_loaded() else 'not loaded')
+
+
+ROOT = _LazyROOT()
@@ -1,12 +1,13 @@
 import uuid
-import ROOT
+import numpy as np
+from lazyroot import ROOT
 
 PDGID_COLORS = {
     1  :  16, # Unspecified track, lightgrey
     13 :  9, # muon, violet
-    11 :  ROOT.kGreen+3, # electron, dark green
+    11 :  419, # electron, dark green (kGreen+3)
     22 :  2, # photon, red
-    211 : ROOT.kOrange+7  # pion, orange
+    211 : 807  # pion, orange (kOrange+7)
     }
 PDGID_OTHER_COLOR = 13 # Anything else, darkgray
 
@@ -22,6 +23,16 @@ PDGID_OTHER_TITLE = 'other'
 def pdgid_to_color(pdgid):
     return PDGID_COLORS.get(abs(pdgid), PDGID_OTHER_COLOR)
 
+def pdgids_to_colors(pdgids):
+    """
+    Like pdgid_to_color, for an array of pdgids
+    """
+    unique_pdgids, inverse = np.unique(pdgids, return_inverse=True)
+    unique_colors = np.array(
+        [ pdgid_to_color(pdgid) for pdgid in unique_pdgids.tolist() ], dtype=np.int64
+        )
+    return unique_colors[inverse]
+
 def pdgid_to_title(pdgid):
     return PDGID_TITLES.get(abs(pdgid), PDGID_OTHER_TITLE)
 
@@ -43,48 +54,116 @@ def pdgid_legend_dummies():
 
 # HGCAL layers
 
-layers = range(1, 28)
-z_pos_layers = [
+# Layer numbers of the EE, and their z positions in both endcaps
+layers = np.arange(1, 29)
+z_pos_layers = np.array([
     322.10275269, 323.04727173, 325.07275391, 326.01730347, 328.04275513,
     328.98727417, 331.01272583, 331.95724487, 333.98275757, 334.92724609,
     336.95275879, 337.89724731, 339.92276001, 340.86727905, 342.89273071,
     343.83724976, 345.86276245, 346.80725098, 348.83276367, 349.7772522,
     351.80276489, 352.7472229,  354.77279663, 355.71725464, 357.74276733,
     358.68725586, 360.71276855, 361.65725708
-    ]
-z_neg_layers = [
+    ])
+z_neg_layers = np.array([
     -322.10275269, -323.04727173, -325.07275391, -326.01730347, -328.04275513,
     -328.98727417, -331.01272583, -331.95724487, -333.98275757, -334.92724609,
     -336.95275879, -337.89724731, -339.92276001, -340.86721802, -342.89279175,
     -343.83724976, -345.86276245, -346.80725098, -348.83276367, -349.7772522,
     -351.80276489, -352.74728394, -354.7727356,  -355.71725464, -357.74276733,
     -358.68725586, -360.71276855, -361.65725708,
-    ]
+    ])
+
+hgcal_zmin_pos = float(z_pos_layers.min())
+hgcal_zmax_pos = float(z_pos_layers.max())
+hgcal_zmin_neg = float(z_neg_layers.min())
+hgcal_zmax_neg = float(z_neg_layers.max())
+
+# z windows per subdetector and endcap. Only the EE layers are tabulated here,
+# so the HGCAL window above is the EE window.
+SUBDETECTOR_WINDOWS = {
+    'EE' : {
+        '+' : (hgcal_zmin_pos, hgcal_zmax_pos),
+        '-' : (hgcal_zmin_neg, hgcal_zmax_neg),
+        },
+    }
 
-hgcal_zmin_pos = min(z_pos_layers)
-hgcal_zmax_pos = max(z_pos_layers)
-hgcal_zmin_neg = min(z_neg_layers)
-hgcal_zmax_neg = max(z_neg_layers)
+# Max distance in z (cm) between a position and a layer to count as on it;
+# a bit less than half the smallest layer spacing
+DEFAULT_LAYER_TOLERANCE = 0.4
+
+# All functions below take a scalar or an array z
 
 def in_hgcal(z):
     """
     Determines whether z is in hgcal
     """
-    return in_hgcal_pos(z) or in_hgcal_neg(z)
+    return in_hgcal_pos(z) | in_hgcal_neg(z)
 
 def in_hgcal_pos(z):
-    return z >= hgcal_zmin_pos and z <= hgcal_zmax_pos
+    return (z >= hgcal_zmin_pos) & (z <= hgcal_zmax_pos)
 
 def in_hgcal_neg(z):
-    return z >= hgcal_zmin_neg and z <= hgcal_zmax_neg
+    return (z >= hgcal_zmin_neg) & (z <= hgcal_zmax_neg)
+
+def get_endcap(z):
+    """
+    Returns 1 for z in the positive endcap, -1 for the negative endcap, and 0
+    outside hgcal
+    """
+    endcap = np.where(in_hgcal_pos(z), 1, np.where(in_hgcal_neg(z), -1, 0))
+    return endcap if np.ndim(z) else int(endcap)
+
+def in_subdetector(z, subdetector='EE'):
+    """
+    Determines whether z is in the z window of `subdetector` (either endcap)
+    """
+    if not subdetector in SUBDETECTOR_WINDOWS:
+        raise ValueError(
+            'No z window for subdetector {0}; available: {1}'
+            .format(subdetector, ', '.join(sorted(SUBDETECTOR_WINDOWS)))
+            )
+    is_in = False
+    for zmin, zmax in SUBDETECTOR_WINDOWS[subdetector].values():
+        is_in = is_in | ((z >= zmin) & (z <= zmax))
+    return is_in
+
+def _nearest_layer_index(z, z_layers):
+    """
+    Returns the index in z_layers nearest to every z, and the distance to it
+    """
+    order = np.argsort(z_layers)
+    sorted_z = z_layers[order]
+    i = np.clip(np.searchsorted(sorted_z, z), 1, len(sorted_z)-1)
+    # Pick the closer one of the two neighbors
+    lower_is_closer = (z - sorted_z[i-1]) <= (sorted_z[i] - z)
+    i = np.where(lower_is_closer, i-1, i)
+    return order[i], np.abs(z - sorted_z[i])
+
+def layer_for_z(z, tolerance=DEFAULT_LAYER_TOLERANCE):
+    """
+    Returns the layer number at z (in the endcap of z), or 0 if z is more than
+    `tolerance` away from every layer
+    """
+    z_array = np.asarray(z, dtype=np.float64)
+    is_pos = z_array >= 0.
+    index_pos, distance_pos = _nearest_layer_index(z_array, z_pos_layers)
+    index_neg, distance_neg = _nearest_layer_index(z_array, z_neg_layers)
+    index = np.where(is_pos, index_pos, index_neg)
+    distance = np.where(is_pos, distance_pos, distance_neg)
+    layer = np.where(distance <= tolerance, layers[index], 0)
+    return layer if z_array.ndim else int(layer)
 
 def get_z_for_layer(layer, do_endcap='+'):
-    if not layer in layers:
+    """
+    Returns the z of a layer number (or an array of layer numbers)
+    """
+    layer_array = np.asarray(layer)
+    is_registered = np.isin(layer_array, layers)
+    if not np.all(is_registered):
         raise ValueError(
-            'Layer {0} is not registered'.format(layer)
+            'Layer {0} is not registered'
+            .format(layer_array[~is_registered].tolist() if layer_array.ndim else layer)
             )
-    index = layers.index(layer)
-    if do_endcap == '+':
-        return z_pos_layers[index]
-    else:
-        return z_neg_layers[index]
+    z_layers = z_pos_layers if do_endcap == '+' else z_neg_layers
+    z = z_layers[layer_array.astype(np.int64) - layers[0]]
+    return z if layer_array.ndim else float(z)
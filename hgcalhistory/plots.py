@@ -6,9 +6,10 @@ import os.path as osp, numpy as np
 from array import array
 from math import pi
 import hgcalhistory
+from instrument import timed
 logger = logging.getLogger('hgcalhistory')
 
-import ROOT
+from lazyroot import ROOT
 
 
 
@@ -33,6 +34,77 @@ def get_plot_base(
     return base
 
 
+def get_grouped_track_polylines(event):
+    """
+    Returns TPolyLine3D's for all tracks with a vertex, colored by pdgid.
+    Tracks that share a vertex and a color go into one line, which runs
+    vertex -> track 1 -> vertex -> track 2 -> ..., so the number of ROOT
+    objects is the number of distinct (vertex, color) pairs.
+    """
+    tracks = event.get_track_arrays()
+    vertexs = event.get_vertex_arrays()
+    vertex_index = tracks['vertex_index']
+    has_vertex = (vertex_index >= 0) & (vertex_index < len(vertexs['id']))
+    tracks = hgcalhistory.bulk.select(tracks, has_vertex)
+    vertexs = hgcalhistory.bulk.select(vertexs, vertex_index[has_vertex])
+    colors = hgcalhistory.physutils.pdgids_to_colors(tracks['pdgid'])
+
+    order = np.lexsort((colors, tracks['vertex_index']))
+    # Segments of shape (n_tracks, 2 points, 3 coordinates), sorted by group
+    segments = np.empty((len(order), 2, 3), dtype=np.float32)
+    segments[:,0,:] = np.column_stack((vertexs['x'], vertexs['y'], vertexs['z']))[order]
+    segments[:,1,:] = np.column_stack((tracks['x'], tracks['y'], tracks['z']))[order]
+    group_keys = np.column_stack((tracks['vertex_index'][order], colors[order]))
+    is_group_start = np.ones(len(order), dtype=bool)
+    is_group_start[1:] = np.any(group_keys[1:] != group_keys[:-1], axis=1)
+    starts = np.nonzero(is_group_start)[0]
+    ends = np.append(starts[1:], len(order))
+
+    lines = []
+    for begin, end in zip(starts.tolist(), ends.tolist()):
+        line = ROOT.TPolyLine3D(2*(end-begin), segments[begin:end].ravel())
+        line.SetLineColor(int(group_keys[begin,1]))
+        ROOT.SetOwnership(line, False)
+        lines.append(line)
+    return lines
+
+
+def check_track_ids(track_ids, tracks):
+    """
+    Raises a ValueError if any nonzero track id is not in the track arrays
+    """
+    is_known = np.isin(track_ids, tracks['id']) | (track_ids == 0)
+    if not np.all(is_known):
+        raise ValueError(
+            'Track ids {0}: no such tracks in event'
+            .format(np.unique(track_ids[~is_known]).tolist())
+            )
+
+
+def get_grouped_hit_polymarkers(event):
+    """
+    Returns one TPolyMarker3D per color for all HGCAL hits in the event,
+    colored by the pdgid of their track (or 9 for track id 0). Raises a
+    ValueError for hits whose track is not in the event.
+    """
+    hits = event.get_hit_arrays()
+    tracks = event.get_track_arrays()
+    check_track_ids(hits['track_id'], tracks)
+    has_track = hits['track_id'] != 0
+    pdgids = hgcalhistory.bulk.join_by_id(tracks['id'], tracks['pdgid'], hits['track_id'])
+    colors = np.where(has_track, hgcalhistory.physutils.pdgids_to_colors(pdgids), 9)
+    markers = []
+    for color in np.unique(colors).tolist():
+        select = colors == color
+        marker = hgcalhistory.event.PositionCollection.from_arrays(
+            hits['x'][select], hits['y'][select], hits['z'][select]
+            ).as_tpolymarker3d(24)
+        marker.SetMarkerColor(color)
+        marker.SetMarkerSize(0.4)
+        markers.append(marker)
+    return markers
+
+
 class PlotBase(object):
     """docstring for PlotBase"""
 
@@ -64,10 +136,12 @@ class PlotBase(object):
         self._has_canvas = True
         self._is_subpad = True
 
+    @timed('PlotBase.plot')
     def plot(self):
         self.__class__.open_canvas()
         self.canvas.Clear()
 
+    @timed('PlotBase.save')
     def save(self):
         if not self._is_subpad:
             logger.debug('Saving {0}_{1}.png/pdf'.format(self.name, self.plotname))
@@ -103,19 +177,24 @@ class HitsPlot(PlotBase):
         self.hist_x.clear_data()
 
 
+    def select_hits(self, event):
+        """
+        Returns the hit arrays of the EE hits in the endcap of this plot, with
+        the layer negated for the negative endcap
+        """
+        hits = event.get_hit_arrays()
+        z = hits['z']
+        in_endcap = (z >= 0.) if self.do_endcap == '+' else (z <= 0.)
+        hits = hgcalhistory.bulk.select(hits, hits['inEE'] & in_endcap)
+        if self.do_endcap == '-':
+            hits['layer'] = -hits['layer']
+        return hits
+
+    @timed('HitsPlot.plot')
     def plot(self, event):
         super(HitsPlot, self).plot()
-        for hit in event.calohits:
-            if not hit.inEE_:
-                continue
-            elif self.do_endcap == '+' and hit.position_.z() < 0.:
-                continue
-            elif self.do_endcap == '-' and hit.position_.z() > 0.:
-                continue
-            layer = hit.layer_
-            if self.do_endcap == '-':
-                layer = -layer
-            self.hist_x.fill(layer, getattr(hit.position_, self.do_coordinate)(), hit.energy())
+        hits = self.select_hits(event)
+        self.hist_x.fill_many(hits['layer'], hits[self.do_coordinate], hits['energy'])
 
         self.plotname += '_' + self.do_coordinate + self.do_endcap
         self.canvas.cd()
@@ -139,70 +218,76 @@ class HitsPlotCoded(HitsPlot):
         self.color_coding = color_coding
         self.hist_x_max = self.hist_x
         self.hist_x_index = copy.deepcopy(self.hist_x)
-        self.hit_counter = 1
 
         self._geant_track_ids = {}
         self._pdgids = {}
         self._counter_ids = 1
 
-    def get_integer_representing_parent(self, hit):
+    def get_codes_representing_parent(self, track_ids):
         """
-        Returns a unique integer per parent track
+        Returns a unique integer per parent track, for an array of track ids.
+        Integers are handed out in order of first appearance, and are kept
+        between calls.
+
+        plot() only passes the hit that ends up with the most energy in each
+        bin, in hit order. The old per-hit loop also handed out integers to
+        hits that led a bin for a while and were beaten later, so the integers
+        (and hence the colors) differ from the ones it gave; which hits share
+        a color is the same.
         """
-        geant_track_id = hit.geantTrackId()
-        if not geant_track_id in self._geant_track_ids:
-            self._geant_track_ids[geant_track_id] = self._counter_ids
-            self._counter_ids += 1
-        return self._geant_track_ids[geant_track_id]
+        unique_ids, first_index, inverse = np.unique(
+            track_ids, return_index=True, return_inverse=True
+            )
+        for track_id in unique_ids[np.argsort(first_index)].tolist():
+            if not track_id in self._geant_track_ids:
+                self._geant_track_ids[track_id] = self._counter_ids
+                self._counter_ids += 1
+        unique_codes = np.array(
+            [ self._geant_track_ids[track_id] for track_id in unique_ids.tolist() ],
+            dtype=np.int64
+            )
+        return unique_codes[inverse]
 
-    def get_integer_representing_pdgid(self, event, hit):
+    def get_codes_representing_pdgid(self, event, track_ids):
         """
-        Returns a unique integer per pdgid
+        Returns the abs(pdgid) of the track of every track id; 1 for track id 0
         """
-        track_id = hit.geantTrackId()
-        if track_id == 0:
-            logger.warning('Hit %s has track id 0; Will give a pdgId of 1', hit)
-            pdgid = 1
-        else:
-            pdgid = abs(event.get_track_by_id(track_id).pdgid())
-        # logger.debug(
-        #     'Hit %s is from track %s which has pdgid %s',
-        #     hit.id(), hit.geantTrackId(), pdgid
-        #     )
-        # if not pdgid in self._pdgids:
-        #     self._pdgids[pdgid] = self._counter_ids
-        #     self._counter_ids += 1
-        # return self._pdgids[pdgid]
-        return pdgid
+        tracks = event.get_track_arrays()
+        no_track = track_ids == 0
+        if np.any(no_track):
+            logger.warning(
+                '%s hits have track id 0; Will give a pdgId of 1',
+                np.count_nonzero(no_track)
+                )
+        check_track_ids(track_ids, tracks)
+        pdgids = np.abs(hgcalhistory.bulk.join_by_id(tracks['id'], tracks['pdgid'], track_ids))
+        return np.where(no_track, 1, pdgids)
 
-    def get_hit_index_for_color_coding(self, event, hit):
+    def get_codes_for_color_coding(self, event, track_ids):
         if self.color_coding == 'parent':
-            return self.get_integer_representing_parent(hit)
+            return self.get_codes_representing_parent(track_ids)
         elif self.color_coding == 'pdgid':
-            return self.get_integer_representing_pdgid(event, hit)
+            return self.get_codes_representing_pdgid(event, track_ids)
 
+    @timed('HitsPlotCoded.plot')
     def plot(self, event):
         super(HitsPlot, self).plot()
-        for hit in event.calohits:
-            if not hit.inEE_:
-                continue
-            elif self.do_endcap == '+' and hit.position_.z() < 0.:
-                continue
-            elif self.do_endcap == '-' and hit.position_.z() > 0.:
-                continue
-            layer = hit.layer_
-            if self.do_endcap == '-':
-                layer = -layer
-            coordinate = getattr(hit.position_, self.do_coordinate)()
-            energy = hit.energy()
-
-            if energy > self.hist_x_max.get_value(layer, coordinate):
-                self.hist_x_max.set_value(layer, coordinate, energy)
-                self.hist_x_index.set_value(
-                    layer,
-                    coordinate,
-                    self.get_hit_index_for_color_coding(event, hit)
-                    )
+        hits = self.select_hits(event)
+        energy = hits['energy']
+        i_x = self.hist_x_max.find_nearest_bin_x(hits['layer'])
+        i_y = self.hist_x_max.find_nearest_bin_y(hits[self.do_coordinate])
+        i_flat = i_x * self.hist_x_max.n_bins_y + i_y
+        # Per bin, pick the hit with the most energy; the first hit wins ties
+        order = np.lexsort((np.arange(len(energy)), -energy, i_flat))
+        is_first_in_bin = np.ones(len(order), dtype=bool)
+        is_first_in_bin[1:] = i_flat[order][1:] != i_flat[order][:-1]
+        winners = np.sort(order[is_first_in_bin])
+        # Only overwrite bins if the hit has more energy than what is in there
+        winners = winners[energy[winners] > self.hist_x_max.data[i_x[winners], i_y[winners]]]
+        self.hist_x_max.data[i_x[winners], i_y[winners]] = energy[winners]
+        self.hist_x_index.data[i_x[winners], i_y[winners]] = self.get_codes_for_color_coding(
+            event, hits['track_id'][winners]
+            )
 
         self.plotname += '_' + self.do_coordinate + self.do_endcap + '_' + self.color_coding
         self.canvas.cd()
@@ -229,41 +314,42 @@ class HitMarkers(PlotBase):
         self.do_endcap = do_endcap
 
     def divide_hits(self, event):
-        graphs = {}
-        for hit in event.calohits:
-            if not hit.inEE_:
-                continue
-            elif self.do_endcap == '+' and hit.position_.z() < 0.:
-                continue
-            elif self.do_endcap == '-' and hit.position_.z() > 0.:
-                continue
-            layer = hit.layer_
-            if self.do_endcap == '-':
-                layer = -layer
-            z = hit.position_.z()
-            coordinate = getattr(hit.position_, self.do_coordinate)()
-
-            track_id = hit.track_id()
-            if track_id == 0:
-                pdgid = -1
-            else:
-                pdgid = abs(event.get_track_by_id(track_id).pdgid())
-
-            if not pdgid in graphs:
-                g = []
-                graphs[pdgid] = g
-            else:
-                g = graphs[pdgid]
-            # g.append((layer, coordinate))
-            g.append((z, coordinate))
-        return { key : np.array(g) for key, g in graphs.iteritems() }
+        """
+        Returns a dict abs(pdgid) -> (n, 2) array of (z, coordinate) of the EE
+        hits in the endcap; pdgid is -1 for hits with track id 0
+        """
+        hits = event.get_hit_arrays()
+        z = hits['z']
+        in_endcap = (z >= 0.) if self.do_endcap == '+' else (z <= 0.)
+        hits = hgcalhistory.bulk.select(hits, hits['inEE'] & in_endcap)
+        track_ids = hits['track_id']
+        tracks = event.get_track_arrays()
+        no_track = track_ids == 0
+        check_track_ids(track_ids, tracks)
+        pdgids = np.abs(hgcalhistory.bulk.join_by_id(tracks['id'], tracks['pdgid'], track_ids))
+        pdgids = np.where(no_track, -1, pdgids)
+        points = np.column_stack((hits['z'], hits[self.do_coordinate]))
+        return { pdgid : points[pdgids == pdgid] for pdgid in np.unique(pdgids).tolist() }
 
     def draw_tracks(self, event):
-        for track in event.tracks:
-            track.get_projected_line(
-                event.get_vertex_for_track(track),
-                do_coordinate = self.do_coordinate
-                ).Draw('SAME')
+        """
+        Draws the vertex -> track segment of every track, projected on the
+        z-coordinate plane
+        """
+        tracks = event.get_track_arrays()
+        vertexs = event.get_vertex_arrays()
+        vertex_index = tracks['vertex_index']
+        has_vertex = (vertex_index >= 0) & (vertex_index < len(vertexs['id']))
+        tracks = hgcalhistory.bulk.select(tracks, has_vertex)
+        vertexs = hgcalhistory.bulk.select(vertexs, vertex_index[has_vertex])
+        colors = hgcalhistory.physutils.pdgids_to_colors(tracks['pdgid'])
+        for i in range(len(tracks['id'])):
+            line = ROOT.TGraph(2)
+            line.SetPoint(0, vertexs['z'][i], vertexs[self.do_coordinate][i])
+            line.SetPoint(1, tracks['z'][i], tracks[self.do_coordinate][i])
+            line.SetLineColor(int(colors[i]))
+            ROOT.SetOwnership(line, False)
+            line.Draw('SAME')
 
     def draw_layer_lines(self, layers=[5, 10, 15, 20]):
         for layer in layers:
@@ -284,6 +370,7 @@ class HitMarkers(PlotBase):
             self.legend.AddEntry(dummy.GetName(), dummy.GetTitle(), 'l')
         self.legend.Draw()
 
+    @timed('HitMarkers.plot')
     def plot(self, event):
         super(HitMarkers, self).plot()
 
@@ -359,6 +446,7 @@ class HitsPlotSplit(PlotBase):
         self.hitsplot_right_upper = hgcalhistory.plots.HitsPlot(self.name, 'x', '+')
         self.hitsplot_right_lower = hgcalhistory.plots.HitsPlot(self.name, 'y', '+')
 
+    @timed('HitsPlotSplit.plot')
     def plot(self, event):
         super(HitsPlotSplit, self).plot()
         self.canvas.SetCanvasSize(2*1000, 2*618)
@@ -416,6 +504,7 @@ class Plot3D(PlotBase):
     
     """
 
+    @timed('Plot3D.plot')
     def plot(self, event):
         super(Plot3D, self).plot()
         self.canvas.SetCanvasSize(1000, 718)
@@ -444,8 +533,8 @@ class Plot3D(PlotBase):
 
     def draw_vertices_and_tracks(self, event):
         # event.vertex_positions.as_tpolymarker3d().Draw()
-        for track in event.tracks:
-            track.get_polyline(event.get_vertex_for_track(track)).Draw()
+        for line in get_grouped_track_polylines(event):
+            line.Draw()
 
     def draw_plane(self, z):
         # plane = ROOT.TF2(
@@ -557,9 +646,5 @@ class Plot3DWithCaloHits(Plot3D):
         Like its parent but also draws the calohits
         """
         super(Plot3DWithCaloHits, self).draw_vertices_and_tracks(event)
-        for hit in event.calohits:
-            track_id = hit.track_id()
-            if track_id == 0:
-                hit.get_polymarker().Draw()
-            else:
-                hit.get_polymarker(track = event.get_track_by_id(hit.track_id())).Draw()
+        for marker in get_grouped_hit_polymarkers(event):
+            marker.Draw()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+RDataFrame backend for the columnar hits and tracks.
+
+The extraction and the HGCAL acceptance cuts of Event.get_hits_columnar and
+Event.get_tracks_columnar (with default arguments) are JIT-compiled C++, run
+in a single (multithreaded) event loop over a whole chain. Only the final
+per-event buffers cross into Python, and they are concatenated in C++ too.
+
+With implicit multithreading, rdfentry_ is not the chain entry. Every event
+is tagged with its file (from the sample info at the start of every task)
+and its entry in that file (counted per slot from the first entry of the
+task), and the output is sorted back into chain order on those. This needs
+DefinePerSample, so ROOT 6.28 or newer.
+"""
+from __future__ import print_function
+import logging
+import numpy as np
+logger = logging.getLogger('hgcalhistory')
+
+from lazyroot import ROOT
+from rootutils import buffer_to_numpy
+from event import TRACKS_BRANCH, VERTEXS_BRANCH, CALOHITS_BRANCH
+from physutils import (
+    hgcal_zmin_pos,
+    hgcal_zmax_pos,
+    hgcal_zmin_neg,
+    hgcal_zmax_neg,
+    )
+
+N_COLUMNS = 9
+
+_CPP_HELPERS = r'''
+#include <algorithm>
+#include <stdexcept>
+#include <unordered_map>
+#include <ROOT/RDF/RSampleInfo.hxx>
+
+namespace hgcalhistory { namespace rdf {
+
+const double zmin_pos = %(zmin_pos)r;
+const double zmax_pos = %(zmax_pos)r;
+const double zmin_neg = %(zmin_neg)r;
+const double zmax_neg = %(zmax_neg)r;
+
+// Same as Event.get_hits_columnar
+std::vector<double> hits_columns(
+        const std::vector<PCaloHitWithPosition>& hits,
+        const std::vector<SimTrack>& tracks
+        ){
+    std::unordered_map<long, int> pdgids;
+    for (const SimTrack& track : tracks) pdgids.emplace(track.trackId(), track.type());
+    std::vector<double> out;
+    out.reserve(hits.size() * %(n_columns)s);
+    for (const PCaloHitWithPosition& hit : hits){
+        if (!(hit.inEE_ || hit.inHsi_ || hit.inHsc_)) continue;
+        const double z = hit.position_.z();
+        if (!((z >= zmin_pos && z <= zmax_pos) || (z >= zmin_neg && z <= zmax_neg))) continue;
+        auto pdgid = pdgids.find(hit.geantTrackId());
+        out.push_back(hit.position_.x());
+        out.push_back(hit.position_.y());
+        out.push_back(z);
+        out.push_back(hit.layer_);
+        out.push_back(hit.time());
+        out.push_back(hit.energy());
+        out.push_back(hit.geantTrackId());
+        out.push_back(hit.inEE_ ? 1. : (hit.inHsi_ ? 2. : 3.));
+        out.push_back(pdgid == pdgids.end() ? 0. : pdgid->second);
+        }
+    return out;
+    }
+
+// Same as Event.get_tracks_columnar
+std::vector<double> tracks_columns(
+        const std::vector<SimTrack>& tracks,
+        const std::vector<SimVertex>& vertices
+        ){
+    std::vector<double> out;
+    out.reserve(tracks.size() * %(n_columns)s);
+    for (const SimTrack& track : tracks){
+        const double x = track.trackerSurfacePosition().X();
+        const double y = track.trackerSurfacePosition().Y();
+        const double z = track.trackerSurfacePosition().Z();
+        if (x == 0. && y == 0. && z == 0.) continue;
+        const int vertex_index = track.vertIndex();
+        if (vertex_index < 0 || vertex_index >= (int)vertices.size()) continue;
+        const SimVertex& vertex = vertices[vertex_index];
+        const double z_v = vertex.position().Z();
+        const bool outside_pos = z > 0. && (
+            (z < zmin_pos && z_v < zmin_pos) || (z > zmax_pos && z_v > zmax_pos)
+            );
+        const bool outside_neg = z < 0. && (
+            (z < zmin_neg && z_v < zmin_neg) || (z > zmax_neg && z_v > zmax_neg)
+            );
+        if (outside_pos || outside_neg) continue;
+        out.push_back(x);
+        out.push_back(y);
+        out.push_back(z);
+        out.push_back(vertex.position().X());
+        out.push_back(vertex.position().Y());
+        out.push_back(z_v);
+        out.push_back(track.type());
+        out.push_back(track.trackId());
+        out.push_back(vertex.vertexId());
+        }
+    return out;
+    }
+
+// The input files with the chain entries where they start, and per slot
+// the local entry of the next event; reset by start_loop before every loop
+std::vector<std::string> input_files;
+std::vector<Long64_t> file_offsets;
+std::vector<Long64_t> slot_entries;
+
+void start_loop(const std::vector<std::string>& files, const Long64_t* offsets, unsigned int n_slots){
+    input_files = files;
+    file_offsets.assign(offsets, offsets + files.size() + 1);
+    slot_entries.assign(n_slots, 0);
+    }
+
+// Called at the start of every task; returns the index of its file
+int start_sample(unsigned int slot, const ROOT::RDF::RSampleInfo& info){
+    const std::string id = info.AsString();
+    int index = -1;
+    size_t match_length = 0;
+    for (size_t i = 0; i < input_files.size(); ++i){
+        if (id == input_files[i] + "/Events"){ index = i; break; }
+        if (info.Contains(input_files[i]) && input_files[i].size() > match_length){
+            index = i;
+            match_length = input_files[i].size();
+            }
+        }
+    if (index < 0) throw std::runtime_error("Sample " + id + " is not one of the input files");
+    slot_entries[slot] = info.EntryRange().first;
+    return index;
+    }
+
+// Entry in the chain of the current event of a slot; events within a task
+// are processed in order
+Long64_t chain_entry(unsigned int slot, int file_index){
+    return file_offsets[file_index] + slot_entries[slot]++;
+    }
+
+void sizes(const std::vector<std::vector<double>>& buffers, long* out){
+    for (size_t i = 0; i < buffers.size(); ++i) out[i] = buffers[i].size();
+    }
+
+void flatten(const std::vector<std::vector<double>>& buffers, const long* order, double* out){
+    for (size_t i = 0; i < buffers.size(); ++i){
+        const std::vector<double>& buffer = buffers[order[i]];
+        std::copy(buffer.begin(), buffer.end(), out);
+        out += buffer.size();
+        }
+    }
+
+}}
+''' % dict(
+    zmin_pos = float(hgcal_zmin_pos),
+    zmax_pos = float(hgcal_zmax_pos),
+    zmin_neg = float(hgcal_zmin_neg),
+    zmax_neg = float(hgcal_zmax_neg),
+    n_columns = N_COLUMNS,
+    )
+
+_HELPERS_DECLARED = False
+def declare_helpers():
+    """
+    Compiles the C++ helpers; only does work on the first call
+    """
+    global _HELPERS_DECLARED
+    if _HELPERS_DECLARED: return
+    logger.debug('Declaring RDataFrame helpers to cling')
+    if not ROOT.gInterpreter.Declare(_CPP_HELPERS):
+        raise RuntimeError('Could not compile the RDataFrame helpers')
+    _HELPERS_DECLARED = True
+
+
+def _flatten(buffers, order):
+    """
+    Concatenates the per-event buffers (a std::vector<std::vector<double>>)
+    in the given order into one (n, N_COLUMNS) array, and returns it with
+    the per-event row offsets
+    """
+    n_events = len(order)
+    sizes = np.zeros(n_events, dtype=np.int64)
+    if n_events > 0:
+        ROOT.hgcalhistory.rdf.sizes(buffers, sizes)
+    sizes = sizes[order]
+    offsets = np.zeros(n_events+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(sizes // N_COLUMNS)
+    out = np.zeros(int(sizes.sum()), dtype=np.float64)
+    if len(out) > 0:
+        ROOT.hgcalhistory.rdf.flatten(buffers, order, out)
+    return out.reshape((-1, N_COLUMNS)), offsets
+
+
+def get_columnar(rootfiles, max_events=None, n_threads=0):
+    """
+    Returns (hits, hit_offsets, tracks, track_offsets) for all events in
+    rootfiles, in chain order: the rows of event i are hits[hit_offsets[i]:
+    hit_offsets[i+1]], with the columns of Event.get_hits_columnar (and
+    likewise for the tracks).
+
+    `n_threads`: number of threads for ROOT's implicit multithreading (0 for
+        all cores, None to leave the current setting alone)
+    """
+    declare_helpers()
+    if n_threads is not None and not ROOT.IsImplicitMTEnabled():
+        ROOT.EnableImplicitMT(n_threads)
+    chain, rootfiles, offsets = _make_chain(rootfiles, max_events)
+    n_expected = int(offsets[-1]) if max_events is None else min(int(offsets[-1]), int(max_events))
+    df = ROOT.RDataFrame(chain)
+    files = ROOT.std.vector['std::string']()
+    for rootfile in rootfiles:
+        files.push_back(rootfile)
+    ROOT.hgcalhistory.rdf.start_loop(files, offsets, df.GetNSlots())
+    df = (df
+        # Defined first and used by the filter below, so both are evaluated
+        # for every event in the order of its task
+        .DefinePerSample('file_index', 'hgcalhistory::rdf::start_sample(rdfslot_, rdfsampleinfo_)')
+        .Define('chain_entry', 'hgcalhistory::rdf::chain_entry(rdfslot_, file_index)')
+        # Range() is not available in multithreaded event loops
+        .Filter('chain_entry < {0}'.format(n_expected))
+        .Alias('sim_tracks', TRACKS_BRANCH + '.obj')
+        .Alias('sim_vertices', VERTEXS_BRANCH + '.obj')
+        .Alias('calo_hits', CALOHITS_BRANCH + '.obj')
+        .Define('hits_columns', 'hgcalhistory::rdf::hits_columns(calo_hits, sim_tracks)')
+        .Define('tracks_columns', 'hgcalhistory::rdf::tracks_columns(sim_tracks, sim_vertices)')
+        )
+    # Book everything before the first GetValue, so there is only one event loop
+    entries = df.Take['Long64_t']('chain_entry')
+    hits = df.Take['std::vector<double>']('hits_columns')
+    tracks = df.Take['std::vector<double>']('tracks_columns')
+    entries = entries.GetValue()
+    hits = hits.GetValue()
+    tracks = tracks.GetValue()
+
+    # Events come out in processing order, which is not the chain order when
+    # multithreaded
+    n_events = entries.size()
+    entries = buffer_to_numpy(entries.data(), n_events, np.int64) if n_events else np.zeros(0, dtype=np.int64)
+    order = np.argsort(entries, kind='mergesort').astype(np.int64)
+    if not np.array_equal(entries[order], np.arange(n_expected)):
+        raise RuntimeError(
+            'RDataFrame did not process entries 0 to {0} of the chain exactly once; '
+            'run with n_threads=None and implicit multithreading disabled'
+            .format(n_expected)
+            )
+    hits, hit_offsets = _flatten(hits, order)
+    tracks, track_offsets = _flatten(tracks, order)
+    logger.info(
+        'Read %s hits and %s tracks in %s events with RDataFrame',
+        len(hits), len(tracks), n_events
+        )
+    return hits, hit_offsets, tracks, track_offsets
+
+
+def _make_chain(rootfiles, max_events=None):
+    """
+    Returns a chain of the files needed for the first max_events events
+    (default: all), the list of those files, and an array of len(files)+1
+    chain entries where every file starts
+    """
+    chain = ROOT.TChain('Events')
+    n_entries = []
+    for rootfile in rootfiles:
+        if max_events is not None and sum(n_entries) >= max_events:
+            break
+        chain.Add(rootfile)
+        n_entries.append(chain.GetEntries() - sum(n_entries))
+    offsets = np.zeros(len(n_entries)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(n_entries)
+    return chain, list(rootfiles[:len(n_entries)]), offsets
@@ -4,13 +4,12 @@ from __future__ import print_function
 
 import os.path as osp
 import logging, os, uuid
+import numpy as np
 from time import strftime
 
 logger = logging.getLogger('root')
 
-import ROOT
-ROOT.gSystem.Load('libFWCoreFWLite')
-ROOT.FWLiteEnabler.enable()
+from lazyroot import ROOT
 PLOTDIR = strftime('plots_hgcalhistory_%b%d')
 
 
@@ -55,6 +54,20 @@ def get_branches(treelike):
     return branch_names
 
 
+def buffer_to_numpy(buffer, n, dtype=np.float64):
+    """
+    Copies the first n elements of a PyROOT pointer buffer (e.g. what
+    TArrayD.GetArray() returns) into a numpy array, in one go
+    """
+    if hasattr(buffer, 'SetSize'):
+        # PyROOT before ROOT 6.22
+        buffer.SetSize(n)
+    else:
+        # cppyy LowLevelView
+        buffer.reshape((n,))
+    return np.frombuffer(buffer, dtype=dtype, count=n).copy()
+
+
 class quick_canvas(object):
     """
     Temporarily open a canvas, for quick plots
@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import os.path as osp
-import logging, subprocess, os, shutil, re, pprint, csv
+import logging, subprocess, os, shutil, re, pprint, csv, json, time, uuid, atexit
+from collections import namedtuple
 import hgcalhistory
 
 logger = logging.getLogger('hgcalhistory')
@@ -116,6 +117,122 @@ def format(src, mgm=None):
     return _join_mgm_lfn(mgm, lfn)
 
 
+# ___________________________________________________________
+# Metadata cache
+
+# Stat info as kept in the cache; same attribute names as XRootD's StatInfo
+StatInfo = namedtuple('StatInfo', [ 'flags', 'size', 'modtime' ])
+
+CACHE_TTL = 300. # seconds; 0 disables caching
+_STATCACHE = {} # path -> (timestamp, StatInfo or None)
+_LISTCACHE = {} # directory -> (timestamp, [ (lfn, StatInfo), ... ])
+_DISK_CACHE_FILE = None
+_DISK_CACHE_DIRTY = False
+_DISK_CACHE_SAVED_AT_EXIT = False
+
+
+def set_cache_ttl(ttl):
+    """
+    Sets how long (in seconds) stat info and directory listings are cached
+    """
+    global CACHE_TTL
+    CACHE_TTL = ttl
+    logger.info('SE metadata cache TTL set to %s s', ttl)
+
+
+def _cache_key(mgm, lfn):
+    return _join_mgm_lfn(mgm, osp.normpath(lfn))
+
+
+def _cache_get(cache, key):
+    """
+    Returns (True, value) if key is cached and not expired, (False, None) otherwise
+    """
+    entry = cache.get(key, None)
+    if entry is None or time.time() - entry[0] > CACHE_TTL:
+        return False, None
+    return True, entry[1]
+
+
+def _cache_set(cache, key, value):
+    global _DISK_CACHE_DIRTY
+    if CACHE_TTL <= 0.:
+        return
+    cache[key] = (time.time(), value)
+    _DISK_CACHE_DIRTY = True
+
+
+def invalidate_cache(path=None):
+    """
+    Drops cached metadata for `path`, everything below it and the listing of
+    its parent directory. Drops everything if path is None.
+    """
+    global _DISK_CACHE_DIRTY
+    _DISK_CACHE_DIRTY = True
+    if path is None:
+        _STATCACHE.clear()
+        _LISTCACHE.clear()
+        return
+    mgm, lfn = split_mgm(path)
+    key = _cache_key(mgm, lfn)
+    parent_key = _cache_key(mgm, osp.dirname(osp.normpath(lfn)))
+    for cache in [ _STATCACHE, _LISTCACHE ]:
+        for cached_key in list(cache.keys()):
+            if cached_key == key or cached_key.startswith(key + '/'):
+                cache.pop(cached_key, None)
+    _LISTCACHE.pop(parent_key, None)
+
+
+def enable_disk_cache(path=None):
+    """
+    Keeps the metadata cache in a json file as well, so it is shared between
+    processes (subject to the same TTL). The file is written at exit and after
+    every walk_root_files.
+    """
+    global _DISK_CACHE_FILE, _DISK_CACHE_SAVED_AT_EXIT
+    if path is None:
+        from hgcalhistory.cache import DEFAULT_CACHE_DIR
+        path = osp.join(DEFAULT_CACHE_DIR, 'se_metadata.json')
+    _DISK_CACHE_FILE = path
+    if osp.isfile(path):
+        with open(path, 'r') as f:
+            contents = json.load(f)
+        for key, (timestamp, statinfo) in contents['stat'].items():
+            _STATCACHE[key] = (timestamp, None if statinfo is None else StatInfo(*statinfo))
+        for key, (timestamp, listing) in contents['list'].items():
+            _LISTCACHE[key] = (timestamp, [ (lfn, StatInfo(*statinfo)) for lfn, statinfo in listing ])
+        logger.info('Loaded SE metadata cache from %s', path)
+    if not _DISK_CACHE_SAVED_AT_EXIT:
+        atexit.register(save_disk_cache)
+        _DISK_CACHE_SAVED_AT_EXIT = True
+
+
+def save_disk_cache():
+    """
+    Writes the metadata cache to the disk cache file, if one is enabled
+    """
+    global _DISK_CACHE_DIRTY
+    if _DISK_CACHE_FILE is None or not _DISK_CACHE_DIRTY:
+        return
+    now = time.time()
+    contents = dict(
+        stat = { key : entry for key, entry in _STATCACHE.items() if now - entry[0] <= CACHE_TTL },
+        list = { key : entry for key, entry in _LISTCACHE.items() if now - entry[0] <= CACHE_TTL },
+        )
+    directory = osp.dirname(_DISK_CACHE_FILE)
+    if directory and not osp.isdir(directory):
+        os.makedirs(directory)
+    tmp_file = _DISK_CACHE_FILE + '.tmp-{0}'.format(uuid.uuid4())
+    with open(tmp_file, 'w') as f:
+        json.dump(contents, f)
+    os.rename(tmp_file, _DISK_CACHE_FILE)
+    _DISK_CACHE_DIRTY = False
+
+
+def _to_cached_statinfo(statinfo):
+    return StatInfo(statinfo.flags, statinfo.size, statinfo.modtime)
+
+
 # ___________________________________________________________
 # Client operations
 
@@ -135,42 +252,52 @@ def create_directory(directory):
             .format(directory, mgm, status)
             )
     logger.info('Created directory %s: %s', directory, status)
+    invalidate_cache(_join_mgm_lfn(mgm, directory))
 
 
 
-def get_statinfo(path):
+def get_statinfo(path, use_cache=True):
     """
+    Returns a StatInfo (flags, size, modtime) for path, or None if it cannot
+    be accessed. Results are cached for CACHE_TTL seconds.
     """
-    import XRootD
     mgm, path = split_mgm(path)
+    key = _cache_key(mgm, path)
+    if use_cache:
+        is_cached, statinfo = _cache_get(_STATCACHE, key)
+        if is_cached:
+            return statinfo
     client = get_client(mgm)
-    
     status, statinfo = client.stat(path)
     if not status.ok:
         logger.info(
             'Trouble accessing {0}: {1}'
             .format(path, status)
             )
-        return None
+        statinfo = None
+    else:
+        statinfo = _to_cached_statinfo(statinfo)
+    _cache_set(_STATCACHE, key, statinfo)
     return statinfo
 
+def is_directory_statinfo(statinfo):
+    """
+    Returns True if the XRootD statinfo object describes a directory
+    """
+    from XRootD.client.flags import StatInfoFlags
+    return bool(statinfo.flags & StatInfoFlags.IS_DIR)
+
 def isdir(directory):
     statinfo = get_statinfo(directory)
     if statinfo is None:
         return False
-    elif statinfo.flags == 19:
-        return True
-    else:
-        return False
+    return is_directory_statinfo(statinfo)
 
 def isfile(directory):
     statinfo = get_statinfo(directory)
     if statinfo is None:
         return False
-    elif statinfo.flags != 19:
-        return True
-    else:
-        return False
+    return not is_directory_statinfo(statinfo)
 
 def copy_to_se(src, dst, create_parent_directory=True):
     """
@@ -185,17 +312,159 @@ def copy_to_se(src, dst, create_parent_directory=True):
     logger.warning('Copying {0} to {1}'.format(src, dst))
     cmd = [ 'xrdcp', '-s', src, dst ]
     hgcalhistory.utils.run_command(cmd)
+    invalidate_cache(dst)
+
+
+def _copy_with_retries(task):
+    """
+    Copies one file for copy_many_to_se. Returns (src, dst, n_bytes, error),
+    with error None on success
+    """
+    src, dst, retries, backoff, verify = task
+    cmd = [ 'xrdcp', '-s', '-f' ]
+    if verify == 'checksum':
+        # Let xrdcp compare the adler32 checksums of source and destination
+        cmd.extend([ '--cksum', 'adler32:source' ])
+    cmd.extend([ src, dst ])
+    n_bytes = os.path.getsize(src)
+    error = None
+    for i_attempt in range(retries + 1):
+        if i_attempt > 0:
+            wait = backoff * 2**(i_attempt-1)
+            logger.warning(
+                'Copying %s failed (%s); retrying in %.1f s', src, error, wait
+                )
+            time.sleep(wait)
+        try:
+            hgcalhistory.utils.run_command(cmd)
+        except subprocess.CalledProcessError as e:
+            error = 'xrdcp exited with {0}'.format(e.returncode)
+            continue
+        finally:
+            invalidate_cache(dst)
+        if verify:
+            statinfo = get_statinfo(dst, use_cache=False)
+            if statinfo is None or statinfo.size != n_bytes:
+                error = 'size mismatch after copy ({0} on SE, {1} local)'.format(
+                    None if statinfo is None else statinfo.size, n_bytes
+                    )
+                continue
+        return src, dst, n_bytes, None
+    return src, dst, n_bytes, error
+
+
+def copy_many_to_se(pairs, n_parallel=4, retries=3, backoff=2., verify='size'):
+    """
+    Copies many local files to the SE concurrently.
+
+    Every distinct parent directory is created only once. Failed transfers are
+    retried `retries` times, waiting backoff, 2*backoff, 4*backoff... seconds.
+    `verify` can be 'size' (compare the remote size to the local one after the
+    copy), 'checksum' (additionally let xrdcp compare adler32 checksums), or
+    None/False.
+
+    Returns a dict with the number of files and bytes copied, the wall time,
+    the throughput in MB/s and a list of (src, dst, error) for failed copies.
+    """
+    from multiprocessing.pool import ThreadPool
+    tasks = []
+    for src, dst in pairs:
+        mgm, lfn = split_mgm(dst)
+        tasks.append((src, _join_mgm_lfn(mgm, lfn), retries, backoff, verify))
+    parent_directories = sorted(set(osp.dirname(task[1]) for task in tasks))
+    logger.warning(
+        'Copying %s files to the SE (%s directories, %s parallel transfers)',
+        len(tasks), len(parent_directories), n_parallel
+        )
+    t_start = time.time()
+    pool = ThreadPool(max(1, n_parallel))
+    try:
+        pool.map(create_directory, parent_directories)
+        results = pool.map(_copy_with_retries, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    wall_time = time.time() - t_start
+
+    failed = [ (src, dst, error) for src, dst, _, error in results if error is not None ]
+    n_bytes = sum(n for _, _, n, error in results if error is None)
+    summary = dict(
+        n_files = len(results) - len(failed),
+        n_bytes = n_bytes,
+        wall_time = wall_time,
+        throughput = n_bytes / 1e6 / wall_time if wall_time > 0. else 0.,
+        failed = failed,
+        )
+    logger.warning(
+        'Copied %s files (%.1f MB) in %.1f s: %.2f MB/s',
+        summary['n_files'], n_bytes / 1e6, wall_time, summary['throughput']
+        )
+    for src, dst, error in failed:
+        logger.error('Failed to copy %s to %s: %s', src, dst, error)
+    return summary
+
 
 def listdir(directory):
     mgm, directory = split_mgm(directory)
+    return [ _join_mgm_lfn(mgm, lfn) for lfn, _ in _listdir_with_statinfo(mgm, directory) ]
+
+
+def _listdir_with_statinfo(mgm, directory):
+    """
+    Returns a list of (lfn, StatInfo) for the contents of `directory`, using
+    the stat info the MGM sends along with the listing.
+    Listings are cached, and fill the stat cache for their entries too.
+    """
+    from XRootD.client.flags import DirListFlags
+    key = _cache_key(mgm, directory)
+    is_cached, listing = _cache_get(_LISTCACHE, key)
+    if is_cached:
+        return listing
     client = get_client(mgm)
-    status, listobj = client.dirlist(directory)
+    status, listobj = client.dirlist(directory, DirListFlags.STAT)
     if not status.ok:
         raise ValueError(
             'Could not list {0}: {1}'
             .format(directory, status)
             )
-    return [ _join_mgm_lfn(mgm, osp.join(directory, item.name)) for item in listobj ]
+    listing = [
+        (osp.join(directory, item.name), _to_cached_statinfo(item.statinfo))
+        for item in listobj
+        ]
+    _cache_set(_LISTCACHE, key, listing)
+    for lfn, statinfo in listing:
+        _cache_set(_STATCACHE, _cache_key(mgm, lfn), statinfo)
+    return listing
+
+
+def walk_root_files(directory, n_threads=8):
+    """
+    Recursively finds all root files under `directory` on the SE.
+    Directories are listed concurrently on `n_threads` threads, one level of
+    the tree at a time. Returns a sorted list of (path, size) pairs; the sizes
+    come from the listings, so no extra stat calls are needed.
+    """
+    from multiprocessing.pool import ThreadPool
+    mgm, directory = split_mgm(directory)
+    root_files = []
+    pool = ThreadPool(n_threads)
+    try:
+        pending = [ directory ]
+        while pending:
+            listings = pool.map(lambda d: _listdir_with_statinfo(mgm, d), pending)
+            pending = []
+            for lfn, statinfo in (entry for listing in listings for entry in listing):
+                if is_directory_statinfo(statinfo):
+                    pending.append(lfn)
+                elif lfn.endswith('.root'):
+                    root_files.append((_join_mgm_lfn(mgm, lfn), statinfo.size))
+    finally:
+        pool.close()
+        pool.join()
+    root_files.sort()
+    logger.info('Found %s root files under %s', len(root_files), _join_mgm_lfn(mgm, directory))
+    save_disk_cache()
+    return root_files
 
 
 def list_root_files(directory):
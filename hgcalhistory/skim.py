@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Slim skims of selected events.
+
+A skim is a .npz file with the HGCAL hits, the tracks and the vertices of a
+set of events as flat columns (the arrays of Event.get_hit_arrays,
+get_track_arrays and get_vertex_arrays, concatenated), plus per-event
+offsets and the source file and entry of every event. EventFactory reads
+.npz skims directly; their events are backed by the arrays only.
+"""
+from __future__ import print_function
+import os, logging, uuid
+import os.path as osp, numpy as np
+from bulk import HIT_FIELDS, TRACK_FIELDS, VERTEX_FIELDS
+logger = logging.getLogger('hgcalhistory')
+
+COLLECTIONS = (
+    ('hits', HIT_FIELDS),
+    ('tracks', TRACK_FIELDS),
+    ('vertices', VERTEX_FIELDS),
+    )
+
+
+def _get_source(event):
+    """
+    Returns (source file, entry in the source file) of event
+    """
+    if event.source is not None:
+        return event.source, event.entry
+    tree = event.rootevent
+    if tree is None:
+        raise ValueError('Event {0} has no source file'.format(event.entry))
+    # event.entry is an entry of the whole chain; LoadTree returns the entry
+    # in the file it is in
+    local_entry = tree.LoadTree(event.entry)
+    return tree.GetFile().GetName(), int(local_entry)
+
+
+def write_skim(events, path):
+    """
+    Writes `events` (any iterable of Events, e.g. EventFactory.select(...))
+    to the skim file `path`. Returns the number of events written.
+    """
+    if not path.endswith('.npz'):
+        raise ValueError('Skim files should end in .npz, got {0}'.format(path))
+    arrays = { collection : [] for collection, _ in COLLECTIONS }
+    entries = []
+    sources = []
+    for event in events:
+        arrays['hits'].append(event.get_hit_arrays())
+        arrays['tracks'].append(event.get_track_arrays())
+        arrays['vertices'].append(event.get_vertex_arrays())
+        source, entry = _get_source(event)
+        entries.append(entry)
+        sources.append(source)
+
+    unique_sources, source_index = np.unique(np.array(sources, dtype=str), return_inverse=True)
+    columns = dict(
+        entry = np.array(entries, dtype=np.int64),
+        source_index = source_index.astype(np.int64),
+        sources = unique_sources,
+        )
+    for collection, fields in COLLECTIONS:
+        offsets = np.zeros(len(entries)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([ len(a['id']) for a in arrays[collection] ])
+        columns[collection + '_offsets'] = offsets
+        for field in fields:
+            columns[collection + '.' + field] = (
+                np.concatenate([ a[field] for a in arrays[collection] ])
+                if len(entries) else np.zeros(0)
+                )
+
+    directory = osp.dirname(path)
+    if directory and not osp.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = path + '.tmp-{0}'.format(uuid.uuid4())
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **columns)
+        os.rename(tmp_path, path)
+    finally:
+        if osp.isfile(tmp_path): os.remove(tmp_path)
+    logger.info(
+        'Wrote %s events (%s hits, %s tracks) to %s',
+        len(entries), len(columns['hits.id']), len(columns['tracks.id']), path
+        )
+    return len(entries)
+
+
+class SkimFile(object):
+    """
+    A skim file in memory. get(i) returns the (hits, tracks, vertices) arrays
+    of event i, as dicts keyed like hgcalhistory.bulk's field tuples.
+    """
+    def __init__(self, path):
+        super(SkimFile, self).__init__()
+        self.path = path
+        self.columns = {}
+        self.offsets = {}
+        with np.load(path) as npz:
+            for collection, fields in COLLECTIONS:
+                self.offsets[collection] = npz[collection + '_offsets']
+                self.columns[collection] = {
+                    field : npz[collection + '.' + field] for field in fields
+                    }
+            self.entry = npz['entry']
+            self.sources = npz['sources']
+            self.source_index = npz['source_index']
+        self.n_events = len(self.entry)
+
+    def __len__(self):
+        return self.n_events
+
+    def _get_collection(self, collection, i):
+        begin, end = self.offsets[collection][i:i+2]
+        return { key : column[begin:end] for key, column in self.columns[collection].items() }
+
+    def get(self, i):
+        return tuple(self._get_collection(collection, i) for collection, _ in COLLECTIONS)
+
+    def get_source(self, i):
+        """
+        Returns (source file, entry in the source file) of event i
+        """
+        return str(self.sources[self.source_index[i]]), int(self.entry[i])
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local staging of remote root files.
+
+Remote (root://) files are copied whole to a local directory before they are
+read, and the next files can be copied in a background thread while the
+current one is processed. The directory is bounded in total size and evicts
+the least recently used files; staged files are reused across runs.
+"""
+from __future__ import print_function
+import os, logging, threading, uuid
+import os.path as osp
+import hgcalhistory
+from cache import DEFAULT_CACHE_DIR, cache_key, get_size_and_mtime
+logger = logging.getLogger('hgcalhistory')
+
+DEFAULT_STAGING_DIR = osp.join(DEFAULT_CACHE_DIR, 'staging')
+DEFAULT_MAX_BYTES = 20 * 1024**3
+
+
+class StagingCache(object):
+    """
+    A size-bounded local directory of copies of remote root files.
+
+    `max_bytes`: total size of the staged files; least recently used files are
+        deleted to stay below it
+    `n_prefetch`: number of upcoming files EventFactory stages in the
+        background
+    """
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES, n_prefetch=1):
+        super(StagingCache, self).__init__()
+        self.directory = DEFAULT_STAGING_DIR if directory is None else directory
+        self.max_bytes = max_bytes
+        self.n_prefetch = n_prefetch
+        self._init_threading()
+
+    def _init_threading(self):
+        self._lock = threading.Lock()
+        self._in_flight = {} # rootfile -> thread staging it
+        self._pinned = set()
+
+    def __getstate__(self):
+        # Locks and threads do not pickle (EventFactory.map sends the kwargs
+        # to other processes)
+        state = self.__dict__.copy()
+        for key in [ '_lock', '_in_flight', '_pinned' ]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_threading()
+
+    def get_path(self, rootfile):
+        return osp.join(
+            self.directory,
+            '{0}_{1}'.format(cache_key(rootfile), osp.basename(rootfile))
+            )
+
+    def is_staged(self, rootfile):
+        return osp.isfile(self.get_path(rootfile))
+
+    def stage(self, rootfile):
+        """
+        Returns a local path with the contents of rootfile, copying it first
+        if needed. Local files are returned as they are. The returned file is
+        not evicted until release(rootfile) is called.
+        """
+        if not rootfile.startswith('root:'):
+            return rootfile
+        with self._lock:
+            thread = self._in_flight.get(rootfile, None)
+        if thread is not None:
+            thread.join()
+        path = self.get_path(rootfile)
+        with self._lock:
+            self._pinned.add(path)
+        if osp.isfile(path):
+            logger.info('Using staged copy %s of %s', path, rootfile)
+            # The mtime keeps track of the last use, for the LRU eviction
+            os.utime(path, None)
+        else:
+            self._copy(rootfile, path)
+        return path
+
+    def release(self, rootfile):
+        """
+        Allows the staged copy of rootfile to be evicted again
+        """
+        if not rootfile.startswith('root:'): return
+        with self._lock:
+            self._pinned.discard(self.get_path(rootfile))
+
+    def prefetch(self, rootfile):
+        """
+        Stages rootfile in a background thread, if it is not staged already
+        """
+        if not rootfile.startswith('root:') or self.is_staged(rootfile):
+            return
+        with self._lock:
+            if rootfile in self._in_flight: return
+            thread = threading.Thread(target=self._prefetch, args=(rootfile,))
+            thread.daemon = True
+            self._in_flight[rootfile] = thread
+        logger.info('Prefetching %s', rootfile)
+        thread.start()
+
+    def _prefetch(self, rootfile):
+        try:
+            self._copy(rootfile, self.get_path(rootfile))
+        except Exception as e:
+            # stage() will try again and raise in the main thread
+            logger.error('Prefetching %s failed: %s', rootfile, e)
+        finally:
+            with self._lock:
+                self._in_flight.pop(rootfile, None)
+
+    def _copy(self, rootfile, path):
+        """
+        Copies rootfile to a temporary file and renames it to path, so an
+        interrupted copy never looks staged
+        """
+        if not osp.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not osp.isdir(self.directory): raise
+        size, _ = get_size_and_mtime(rootfile)
+        self.evict(size)
+        tmp_path = path + '.tmp-{0}'.format(uuid.uuid4())
+        logger.info('Staging %s to %s', rootfile, path)
+        try:
+            hgcalhistory.utils.run_command([ 'xrdcp', '-s', '-f', rootfile, tmp_path ])
+            os.rename(tmp_path, path)
+        finally:
+            if osp.isfile(tmp_path): os.remove(tmp_path)
+
+    def get_staged_files(self):
+        """
+        Returns a list of (path, size, last use) of all staged files
+        """
+        if not osp.isdir(self.directory): return []
+        staged = []
+        for name in os.listdir(self.directory):
+            if '.tmp-' in name: continue
+            path = osp.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue # Evicted by another process in the meantime
+            staged.append((path, stat.st_size, stat.st_mtime))
+        return staged
+
+    def total_bytes(self):
+        return sum(size for _, size, _ in self.get_staged_files())
+
+    def evict(self, n_bytes_needed=0):
+        """
+        Deletes least recently used files until n_bytes_needed more bytes fit
+        under max_bytes. Files in use (see stage/release) are kept.
+        """
+        staged = sorted(self.get_staged_files(), key=lambda f: f[2])
+        total = sum(size for _, size, _ in staged)
+        with self._lock:
+            pinned = set(self._pinned)
+        for path, size, _ in staged:
+            if total + n_bytes_needed <= self.max_bytes: break
+            if path in pinned: continue
+            logger.info('Evicting staged file %s (%s bytes)', path, size)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        if total + n_bytes_needed > self.max_bytes:
+            logger.warning(
+                'Staging directory %s exceeds its limit of %s bytes',
+                self.directory, self.max_bytes
+                )
+
+    def clear(self):
+        logger.warning('Deleting all staged files in %s', self.directory)
+        for path, _, _ in self.get_staged_files():
+            os.remove(path)
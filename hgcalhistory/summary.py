@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per-event summaries of root files, for skimming without reading the events.
+
+An indexing pass reads every event of a root file once and stores a few
+numbers per event (counts, EE energy, has_photon and the pdgids present) in a
+small .npz sidecar. EventFactory.select uses the sidecars to find matching
+entries, and then only reads those.
+"""
+from __future__ import print_function
+import os, logging, uuid
+import os.path as osp, numpy as np
+import hgcalhistory
+from cache import DEFAULT_CACHE_DIR, cache_key
+logger = logging.getLogger('hgcalhistory')
+
+DEFAULT_SUMMARY_DIR = osp.join(DEFAULT_CACHE_DIR, 'summaries')
+
+# Per-event fields of a summary
+SUMMARY_FIELDS = (
+    'entry', 'n_tracks', 'n_vertexs', 'n_hits_EE', 'n_hits_Hsi', 'n_hits_Hsc',
+    'energy_EE', 'has_photon',
+    )
+
+
+def summarize_event(event):
+    """
+    Returns a dict with the SUMMARY_FIELDS of event, plus 'pdgids': the
+    sorted unique pdgids of its tracks
+    """
+    hits = event.get_hit_arrays()
+    tracks = event.get_track_arrays()
+    pdgids = np.unique(tracks['pdgid'])
+    return dict(
+        entry = event.entry,
+        n_tracks = len(tracks['id']),
+        n_vertexs = len(event.get_vertex_arrays()['id']),
+        n_hits_EE = int(hits['inEE'].sum()),
+        n_hits_Hsi = int(hits['inHsi'].sum()),
+        n_hits_Hsc = int(hits['inHsc'].sum()),
+        energy_EE = float(hits['energy'][hits['inEE']].sum()),
+        has_photon = bool(np.any(pdgids == 22)),
+        pdgids = pdgids,
+        )
+
+
+class Summary(object):
+    """
+    The per-event summary of one root file. Every field in SUMMARY_FIELDS is
+    an array with one element per event; the pdgids of event i are
+    pdgids[pdgids_indptr[i]:pdgids_indptr[i+1]].
+    """
+    def __init__(self, arrays):
+        super(Summary, self).__init__()
+        for key, value in arrays.items():
+            setattr(self, key, value)
+        self.n_events = len(self.entry)
+
+    @classmethod
+    def from_events(cls, events):
+        summaries = [ summarize_event(event) for event in events ]
+        arrays = {}
+        for field in SUMMARY_FIELDS:
+            dtype = { 'energy_EE' : np.float64, 'has_photon' : bool }.get(field, np.int64)
+            arrays[field] = np.array([ s[field] for s in summaries ], dtype=dtype)
+        arrays['pdgids_indptr'] = np.zeros(len(summaries)+1, dtype=np.int64)
+        arrays['pdgids_indptr'][1:] = np.cumsum([ len(s['pdgids']) for s in summaries ])
+        arrays['pdgids'] = (
+            np.concatenate([ s['pdgids'] for s in summaries ]) if len(summaries)
+            else np.zeros(0, dtype=np.int64)
+            )
+        return cls(arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            return cls({ key : npz[key] for key in npz.files })
+
+    def save(self, path):
+        keys = SUMMARY_FIELDS + ('pdgids_indptr', 'pdgids')
+        with open(path, 'wb') as f:
+            np.savez(f, **{ key : getattr(self, key) for key in keys })
+
+    def __len__(self):
+        return self.n_events
+
+    def contains_pdgid(self, pdgids):
+        """
+        Returns a boolean array: whether each event has a track with any of
+        `pdgids` (an int or a list of ints)
+        """
+        is_match = np.isin(self.pdgids, np.atleast_1d(pdgids))
+        event_of_pdgid = np.repeat(np.arange(self.n_events), np.diff(self.pdgids_indptr))
+        return np.bincount(event_of_pdgid[is_match], minlength=self.n_events) > 0
+
+    def match(self, predicate=None, **requirements):
+        """
+        Returns a boolean array: whether each event passes.
+
+        `predicate`: a function that takes this Summary and returns a boolean
+            array over the events
+        `requirements`: field=value requires equality, min_field=value and
+            max_field=value require field >= value and field <= value, and
+            pdgid=value (or a list) requires a track with that pdgid
+        """
+        passes = np.ones(self.n_events, dtype=bool)
+        if predicate is not None:
+            passes &= np.asarray(predicate(self), dtype=bool)
+        for key, value in requirements.items():
+            if key == 'pdgid':
+                passes &= self.contains_pdgid(value)
+            elif key.startswith('min_') and key[4:] in SUMMARY_FIELDS:
+                passes &= getattr(self, key[4:]) >= value
+            elif key.startswith('max_') and key[4:] in SUMMARY_FIELDS:
+                passes &= getattr(self, key[4:]) <= value
+            elif key in SUMMARY_FIELDS:
+                passes &= getattr(self, key) == value
+            else:
+                raise ValueError(
+                    'Unknown requirement {0}; valid fields are {1}'
+                    .format(key, ', '.join(SUMMARY_FIELDS))
+                    )
+        return passes
+
+
+class SummaryIndex(object):
+    """
+    Manages a directory of Summary sidecars, one per root file, keyed like
+    the columnar cache (path, size and mtime of the root file)
+    """
+    def __init__(self, directory=None):
+        super(SummaryIndex, self).__init__()
+        self.directory = DEFAULT_SUMMARY_DIR if directory is None else directory
+
+    def get_path(self, rootfile):
+        return osp.join(self.directory, cache_key(rootfile) + '.npz')
+
+    def is_built(self, rootfile):
+        return osp.isfile(self.get_path(rootfile))
+
+    def build(self, rootfile, path=None):
+        """
+        Reads every event of rootfile once and writes its Summary
+        """
+        if path is None: path = self.get_path(rootfile)
+        logger.info('Building event summary for %s in %s', rootfile, path)
+        summary = Summary.from_events(hgcalhistory.event.EventFactory(rootfile))
+        if not osp.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not osp.isdir(self.directory): raise
+        tmp_path = path + '.tmp-{0}'.format(uuid.uuid4())
+        try:
+            summary.save(tmp_path)
+            os.rename(tmp_path, path)
+        finally:
+            if osp.isfile(tmp_path): os.remove(tmp_path)
+        return summary
+
+    def load(self, rootfile):
+        """
+        Returns the Summary of rootfile, building it if needed
+        """
+        path = self.get_path(rootfile)
+        if not osp.isfile(path):
+            return self.build(rootfile, path)
+        return Summary.load(path)
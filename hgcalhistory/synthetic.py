@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Synthetic events, for benchmarks and for trying things out without a
+GEN-SIM file.
+
+generate_arrays makes the hit, track and vertex arrays of one event (keyed
+like hgcalhistory.bulk's field tuples), with hits on the HGCAL layers of
+physutils. StandInTree wraps such events in local stand-ins for the PyROOT
+objects (the Events tree, the EDM products, SimTrack, SimVertex and
+PCaloHitWithPosition), so Event can read them like a real tree.
+"""
+from __future__ import print_function
+import logging
+import numpy as np
+logger = logging.getLogger('hgcalhistory')
+
+from bulk import HIT_FIELDS, TRACK_FIELDS, VERTEX_FIELDS
+from physutils import z_pos_layers
+from event import TRACKS_BRANCH, VERTEXS_BRANCH, CALOHITS_BRANCH
+
+# Fractions of tracks/hits that exercise the cuts and edge cases
+FRACTION_TRACKS_AT_ORIGIN = 0.02
+FRACTION_TRACKS_WITHOUT_VERTEX = 0.02
+FRACTION_TRACKS_OUTSIDE_HGCAL = 0.1
+FRACTION_HITS_WITHOUT_TRACK = 0.02
+FRACTION_HITS_OUTSIDE_HGCAL = 0.05
+
+PDGIDS = np.array([ 22, 11, -11, 13, -13, 211, -211, 2212, 2112, 321 ])
+
+
+def generate_arrays(rng, n_tracks=500, n_vertices=250, n_hits=5000):
+    """
+    Returns (hits, tracks, vertices) arrays of one synthetic event, using the
+    numpy RandomState `rng`
+    """
+    z_layers = np.array(z_pos_layers)
+
+    # Tracks end close to a random layer, in a random endcap
+    sign = rng.choice([-1., 1.], n_tracks)
+    tracks = dict(
+        x = rng.normal(0., 50., n_tracks),
+        y = rng.normal(0., 50., n_tracks),
+        z = sign * (rng.choice(z_layers, n_tracks) + rng.normal(0., 1., n_tracks)),
+        energy = rng.exponential(10., n_tracks),
+        pdgid = rng.choice(PDGIDS, n_tracks).astype(np.int64),
+        id = rng.permutation(n_tracks).astype(np.int64) + 1,
+        )
+    outside = rng.rand(n_tracks) < FRACTION_TRACKS_OUTSIDE_HGCAL
+    tracks['z'][outside] = rng.uniform(-100., 100., np.count_nonzero(outside))
+    at_origin = rng.rand(n_tracks) < FRACTION_TRACKS_AT_ORIGIN
+    for coordinate in 'xyz':
+        tracks[coordinate][at_origin] = 0.
+
+    # Vertex 0 is the primary vertex (parent track id 0); the parent tracks of
+    # the other vertices are spread over the tracks in order. A track only
+    # starts from a vertex of an earlier track, so the ancestry is a tree.
+    parent_index = (np.arange(n_vertices) * n_tracks) // max(n_vertices, 1)
+    vertices = dict(
+        x = rng.normal(0., 50., n_vertices),
+        y = rng.normal(0., 50., n_vertices),
+        z = rng.choice([-1., 1.], n_vertices) * rng.uniform(300., 365., n_vertices),
+        id = np.arange(n_vertices, dtype=np.int64),
+        track_id = tracks['id'][parent_index] if n_tracks else np.zeros(n_vertices, dtype=np.int64),
+        )
+    if n_vertices: vertices['track_id'][0] = 0
+    n_allowed = np.maximum(np.searchsorted(parent_index, np.arange(n_tracks)), 1)
+    tracks['vertex_index'] = (rng.rand(n_tracks) * n_allowed).astype(np.int64)
+    if not n_vertices: tracks['vertex_index'][:] = -1
+    tracks['vertex_index'][rng.rand(n_tracks) < FRACTION_TRACKS_WITHOUT_VERTEX] = -1
+
+    # Hits sit on a layer, spread around the track that made them
+    layer = rng.randint(1, len(z_layers)+1, n_hits).astype(np.int64)
+    hit_track = rng.randint(0, max(n_tracks, 1), n_hits)
+    track_x = tracks['x'][hit_track] if n_tracks else np.zeros(n_hits)
+    track_y = tracks['y'][hit_track] if n_tracks else np.zeros(n_hits)
+    detector = rng.choice(3, n_hits, p=[ .7, .2, .1 ])
+    hits = dict(
+        x = track_x + rng.normal(0., 3., n_hits),
+        y = track_y + rng.normal(0., 3., n_hits),
+        z = rng.choice([-1., 1.], n_hits) * z_layers[layer-1],
+        layer = layer,
+        time = rng.exponential(5., n_hits),
+        energy = rng.exponential(1e-4, n_hits),
+        track_id = tracks['id'][hit_track] if n_tracks else np.zeros(n_hits, dtype=np.int64),
+        id = rng.randint(0, 2**31, n_hits).astype(np.int64),
+        inEE = detector == 0,
+        inHsi = detector == 1,
+        inHsc = detector == 2,
+        )
+    hits['track_id'][rng.rand(n_hits) < FRACTION_HITS_WITHOUT_TRACK] = 0
+    outside = rng.rand(n_hits) < FRACTION_HITS_OUTSIDE_HGCAL
+    for field in [ 'inEE', 'inHsi', 'inHsc' ]:
+        hits[field][outside] = False
+
+    assert set(hits) == set(HIT_FIELDS)
+    assert set(tracks) == set(TRACK_FIELDS)
+    assert set(vertices) == set(VERTEX_FIELDS)
+    return hits, tracks, vertices
+
+
+def generate_events(n_events=10, seed=1, **kwargs):
+    """
+    Returns a list of n_events (hits, tracks, vertices) tuples; kwargs are
+    passed to generate_arrays
+    """
+    rng = np.random.RandomState(seed)
+    return [ generate_arrays(rng, **kwargs) for _ in range(n_events) ]
+
+
+# ___________________________________________________________
+# Stand-ins for the PyROOT objects
+
+class _Point(object):
+    def __init__(self, x, y, z, e=0.):
+        self._xyz = (x, y, z)
+        self._e = e
+
+    def x(self): return self._xyz[0]
+    def y(self): return self._xyz[1]
+    def z(self): return self._xyz[2]
+    def X(self): return self._xyz[0]
+    def Y(self): return self._xyz[1]
+    def Z(self): return self._xyz[2]
+    def E(self): return self._e
+
+
+class StandInSimTrack(object):
+    def __init__(self, x, y, z, energy, pdgid, id, vertex_index):
+        self._position = _Point(x, y, z)
+        self._momentum = _Point(0., 0., 0., energy)
+        self._pdgid = int(pdgid)
+        self._id = int(id)
+        self._vertex_index = int(vertex_index)
+
+    def trackerSurfacePosition(self): return self._position
+    def momentum(self): return self._momentum
+    def type(self): return self._pdgid
+    def trackId(self): return self._id
+    def vertIndex(self): return self._vertex_index
+
+
+class StandInSimVertex(object):
+    def __init__(self, x, y, z, id, track_id):
+        self._position = _Point(x, y, z)
+        self._id = int(id)
+        self._track_id = int(track_id)
+
+    def position(self): return self._position
+    def vertexId(self): return self._id
+    def parentIndex(self): return self._track_id
+
+
+class StandInCaloHit(object):
+    def __init__(self, x, y, z, layer, time, energy, track_id, id, inEE, inHsi, inHsc):
+        self.position_ = _Point(x, y, z)
+        self.layer_ = int(layer)
+        self._time = time
+        self._energy = energy
+        self._track_id = int(track_id)
+        self._id = int(id)
+        self.inEE_ = bool(inEE)
+        self.inHsi_ = bool(inHsi)
+        self.inHsc_ = bool(inHsc)
+
+    def time(self): return self._time
+    def energy(self): return self._energy
+    def geantTrackId(self): return self._track_id
+    def id(self): return self._id
+
+
+class StandInCollection(list):
+    """
+    Stand-in for a std::vector of EDM objects
+    """
+    def size(self):
+        return len(self)
+
+
+def _to_objects(cls, arrays, fields):
+    columns = [ arrays[field].tolist() for field in fields ]
+    return StandInCollection(cls(*values) for values in zip(*columns))
+
+
+class _StandInWrapper(object):
+    """
+    Stand-in for an edm::Wrapper branch
+    """
+    def __init__(self, collection):
+        self._collection = collection
+
+    def product(self):
+        return self._collection
+
+
+class _StandInBranch(object):
+    """
+    Stand-in for a TBranch of one of the products; GetEntry(i) puts the
+    product of entry i on the tree
+    """
+    def __init__(self, tree, name, i_product):
+        self._tree = tree
+        self._name = name
+        self._i_product = i_product
+        self._read_entry = -1
+
+    def GetReadEntry(self):
+        return self._read_entry
+
+    def GetEntry(self, i):
+        setattr(self._tree, self._name, _StandInWrapper(self._tree._products[i][self._i_product]))
+        self._read_entry = i
+        return 1
+
+
+class StandInTree(object):
+    """
+    Stand-in for the Events tree (a chain of one file), over a list of (hits,
+    tracks, vertices) tuples as returned by generate_events. Like a TTree,
+    GetEntry reads all branches, while LoadTree reads none and GetBranch(name)
+    gives the branch to read a single product.
+    """
+    def __init__(self, events):
+        super(StandInTree, self).__init__()
+        self.events = events
+        self._read_entry = -1
+        # Build the stand-in objects up front, so GetEntry is cheap like for
+        # a real tree
+        self._products = [
+            (
+                _to_objects(StandInCaloHit, hits, HIT_FIELDS),
+                _to_objects(StandInSimTrack, tracks, TRACK_FIELDS),
+                _to_objects(StandInSimVertex, vertices, VERTEX_FIELDS),
+                )
+            for hits, tracks, vertices in events
+            ]
+        self._branches = {
+            name : _StandInBranch(self, name, i_product)
+            for i_product, name in enumerate([ CALOHITS_BRANCH, TRACKS_BRANCH, VERTEXS_BRANCH ])
+            }
+
+    def GetEntries(self):
+        return len(self.events)
+
+    def GetReadEntry(self):
+        return self._read_entry
+
+    def LoadTree(self, i):
+        self._read_entry = i
+        return i
+
+    def GetBranch(self, name):
+        return self._branches.get(name, None)
+
+    def GetEntry(self, i):
+        self.LoadTree(i)
+        for branch in self._branches.values():
+            branch.GetEntry(i)
+        return 1
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import os, shutil, logging
+import os, shutil, logging, glob, csv, json, subprocess
 import os.path as osp
 import hgcalhistory
 logger = logging.getLogger('hgcalhistory')
@@ -84,13 +84,37 @@ def is_string(string):
     return isinstance(string, basestring)
 
 
-def smart_list_root_files(rootfiles):
+def run_command(cmd):
+    """
+    Runs a command, logging its output. Raises subprocess.CalledProcessError
+    if the command fails.
+
+    :param cmd: The command and its arguments
+    :type cmd: list
+    :returns: The output (stdout and stderr combined) as a list of lines
+    """
+    logger.info('Issuing command: {0}'.format(' '.join(cmd)))
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True
+        )
+    output, _ = process.communicate()
+    output = output.splitlines()
+    for line in output:
+        logger.debug(line)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, '\n'.join(output))
+    return output
+
+
+def smart_list_root_files(rootfiles, n_threads=8):
     """
     Takes a variable input `rootfiles`, and returns a formatted list of valid paths to
-    root files.
+    root files. Directories on the SE are searched recursively.
 
     :param rootfiles: A string or list of paths to root files, or directories containing root files
     :type rootfiles: str, list
+    :param n_threads: Number of threads used to list directories on the SE
+    :type n_threads: int, optional
     """
 
     if is_string(rootfiles):
@@ -99,14 +123,17 @@ def smart_list_root_files(rootfiles):
     processed_root_files = []
     for rootfile in rootfiles:
         if rootfile.startswith('root:'):
-            # This is on SE
-            if hgcalhistory.seutils.isdir(rootfile):
-                # It's a directory
-                processed_root_files.extend(hgcalhistory.seutils.list_root_files(rootfile))
-            elif hgcalhistory.seutils.isfile(rootfile):
-                processed_root_files.append(hgcalhistory.seutils.format(rootfile))
-            else:
+            # This is on SE; a single stat tells whether it's a directory
+            statinfo = hgcalhistory.seutils.get_statinfo(rootfile)
+            if statinfo is None:
                 logger.error('Remote rootfile %s could not be found', rootfile)
+            elif hgcalhistory.seutils.is_directory_statinfo(statinfo):
+                processed_root_files.extend(
+                    path for path, size in
+                    hgcalhistory.seutils.walk_root_files(rootfile, n_threads=n_threads)
+                    )
+            else:
+                processed_root_files.append(hgcalhistory.seutils.format(rootfile))
         else:
             # This is local
             if osp.isdir(rootfile):
@@ -121,3 +148,91 @@ def smart_list_root_files(rootfiles):
     if len(processed_root_files) == 0:
         logger.warning('No root files were found in %s', rootfiles)
     return processed_root_files
+
+
+class LoggerStream(object):
+    """
+    File-like object that sends every written line to a logger
+    """
+    def __init__(self, logger, level=logging.DEBUG):
+        super(LoggerStream, self).__init__()
+        self.logger = logger
+        self.level = level
+        self._buffer = ''
+
+    def write(self, text):
+        lines = (self._buffer + text).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            self.logger.log(self.level, line)
+
+    def flush(self):
+        if self._buffer:
+            self.logger.log(self.level, self._buffer)
+            self._buffer = ''
+
+
+class TableWriter(object):
+    """
+    Streams rows to a file handle as aligned text ('text'), CSV ('csv') or
+    one JSON object per line ('jsonl'). Rows are sequences matching `columns`.
+    After `max_rows` rows (if given) further rows are dropped; check `is_full`
+    to stop producing them.
+    """
+    formats = [ 'text', 'csv', 'jsonl' ]
+
+    def __init__(self, stream, columns, fmt='text', max_rows=None, width=12):
+        super(TableWriter, self).__init__()
+        if not fmt in self.formats:
+            raise ValueError(
+                'Unknown format {0}; choose from {1}'.format(fmt, self.formats)
+                )
+        self.stream = stream
+        self.columns = list(columns)
+        self.fmt = fmt
+        self.max_rows = max_rows
+        self.width = width
+        self.n_rows = 0
+        if self.fmt == 'csv':
+            self._csv_writer = csv.writer(self.stream)
+        self._header_written = False
+
+    @property
+    def rows_left(self):
+        return None if self.max_rows is None else max(self.max_rows - self.n_rows, 0)
+
+    @property
+    def is_full(self):
+        return self.rows_left == 0
+
+    def _format_text(self, value):
+        if isinstance(value, float):
+            value = '{0:.3f}'.format(value)
+        return '{0:>{width}}'.format(value, width=self.width)
+
+    def _write_header(self):
+        self._header_written = True
+        if self.fmt == 'text':
+            self.stream.write(' '.join(self._format_text(c) for c in self.columns) + '\n')
+        elif self.fmt == 'csv':
+            self._csv_writer.writerow(self.columns)
+
+    def write_rows(self, rows):
+        """
+        Writes rows until max_rows is reached; returns the number written
+        """
+        if not self._header_written:
+            self._write_header()
+        n_written = 0
+        for row in rows:
+            if self.is_full:
+                break
+            if self.fmt == 'text':
+                self.stream.write(' '.join(self._format_text(v) for v in row) + '\n')
+            elif self.fmt == 'csv':
+                self._csv_writer.writerow(row)
+            else:
+                self.stream.write(json.dumps(dict(zip(self.columns, row))) + '\n')
+            self.n_rows += 1
+            n_written += 1
+        return n_written
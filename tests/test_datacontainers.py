@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from array import array
+import numpy as np
+import pytest
+
+from hgcalhistory.datacontainers import Histogram2D, NearestBin
+
+try:
+    import ROOT
+except ImportError:
+    ROOT = None
+requires_root = pytest.mark.skipif(ROOT is None, reason='needs ROOT')
+
+
+def make_TH2(class_name, x_bounds, y_bounds, data):
+    TH2 = getattr(ROOT, class_name)(
+        'test_{0}'.format(class_name), '',
+        len(x_bounds)-1, array('d', x_bounds),
+        len(y_bounds)-1, array('d', y_bounds),
+        )
+    for i_x in range(data.shape[0]):
+        for i_y in range(data.shape[1]):
+            TH2.SetBinContent(i_x+1, i_y+1, data[i_x, i_y])
+    return TH2
+
+
+@requires_root
+@pytest.mark.parametrize('class_name', [ 'TH2D', 'TH2F', 'TH2I', 'TH2S' ])
+def test_from_TH2_round_trip(class_name):
+    rng = np.random.RandomState(1)
+    x_bounds = np.linspace(0., 54., 28)
+    y_bounds = np.sort(rng.uniform(-250., 250., 14))
+    data = rng.randint(0, 1000, (len(x_bounds)-1, len(y_bounds)-1)).astype(np.float64)
+    if class_name in ('TH2D', 'TH2F'):
+        data += rng.rand(*data.shape)
+    TH2 = make_TH2(class_name, x_bounds, y_bounds, data)
+
+    hist = Histogram2D.from_TH2(TH2)
+    np.testing.assert_allclose(hist.x_bin_boundaries, x_bounds)
+    np.testing.assert_allclose(hist.y_bin_boundaries, y_bounds)
+    assert hist.data.dtype == np.float64
+    expected = data.astype(np.float32) if class_name == 'TH2F' else data
+    np.testing.assert_allclose(hist.data, expected, rtol=1e-6)
+
+
+@requires_root
+def test_to_TH2_from_TH2_round_trip():
+    hist = Histogram2D()
+    hist.set_x_bin_boundaries(np.linspace(0., 54., 55))
+    hist.set_y_bin_boundaries(np.linspace(-250., 250., 200))
+    hist.data = np.random.RandomState(2).rand(54, 199)
+    np.testing.assert_array_equal(Histogram2D.from_TH2(hist.to_TH2()).data, hist.data)
+
+
+def nearest_bin_loop(centers, xs):
+    """
+    NearestBin as the argmin scan it replaced, one x at a time
+    """
+    return np.array([ np.abs(centers - x).argmin() for x in xs ], dtype=np.int64)
+
+
+CENTERS = [
+    np.arange(54.) + 0.5,
+    (np.linspace(-250., 250., 200)[:-1] + np.linspace(-250., 250., 200)[1:]) / 2.,
+    np.sort(np.random.RandomState(4).uniform(-250., 250., 37)),
+    np.array([ 3. ]),
+    ]
+
+
+@pytest.mark.parametrize('centers', CENTERS)
+def test_nearest_bin_matches_argmin(centers):
+    nearest_bin = NearestBin(centers)
+    rng = np.random.RandomState(5)
+    span = centers[-1] - centers[0] + 1.
+    xs = np.concatenate((
+        rng.uniform(centers[0] - span, centers[-1] + span, 5000),
+        centers,
+        [ -1e9, 1e9 ],
+        ))
+    expected = nearest_bin_loop(centers, xs)
+    np.testing.assert_array_equal(nearest_bin(xs), expected)
+    for x, i in zip(xs[::100], expected[::100]):
+        assert nearest_bin(x) == i
+
+
+@pytest.mark.parametrize('centers', CENTERS[:3])
+def test_nearest_bin_midpoints_go_to_lower_bin(centers):
+    nearest_bin = NearestBin(centers)
+    midpoints = (centers[:-1] + centers[1:]) / 2.
+    np.testing.assert_array_equal(nearest_bin(midpoints), np.arange(len(midpoints)))
+    np.testing.assert_array_equal(nearest_bin(midpoints), np.searchsorted(nearest_bin.midpoints, midpoints))
+
+
+def test_nearest_bin_not_increasing():
+    centers = np.array([ 5., -2., 11., 0.5 ])
+    xs = np.random.RandomState(6).uniform(-10., 20., 500)
+    np.testing.assert_array_equal(NearestBin(centers)(xs), nearest_bin_loop(centers, xs))
+    assert NearestBin(centers)(4.) == 0
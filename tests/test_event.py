@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The vectorized Event methods against the per-object loops they replaced, on
+synthetic events (no ROOT needed)
+"""
+import numpy as np
+import pytest
+
+from hgcalhistory import physutils
+from hgcalhistory.event import Event, CALOHITS_BRANCH, TRACKS_BRANCH, VERTEXS_BRANCH
+from hgcalhistory.synthetic import generate_events, StandInTree
+
+N_EVENTS = 5
+
+
+@pytest.fixture(scope='module')
+def tree():
+    events = generate_events(N_EVENTS, seed=3, n_tracks=200, n_vertices=100, n_hits=2000)
+    for hits, _, _ in events:
+        # Hits of tracks that are not in the event, and hits outside HGCAL
+        hits['track_id'][:5] = 10**9
+        hits['z'][5:10] = 100.
+    return StandInTree(events)
+
+
+def get_event(tree, i):
+    tree.LoadTree(i)
+    return Event(tree, entry=i)
+
+
+def get_products(tree, i):
+    """
+    Returns the (calohits, tracks, vertices) stand-in objects of entry i
+    """
+    tree.GetEntry(i)
+    return [
+        getattr(tree, branch).product()
+        for branch in [ CALOHITS_BRANCH, TRACKS_BRANCH, VERTEXS_BRANCH ]
+        ]
+
+
+def hits_columnar_loop(calohits, tracks, only_in_hgcal=True):
+    """
+    Event.get_hits_columnar as a loop over the hit objects
+    """
+    rows = []
+    for hit in calohits:
+        if not(hit.inEE_ or hit.inHsi_ or hit.inHsc_):
+            continue
+        x, y, z = hit.position_.x(), hit.position_.y(), hit.position_.z()
+        if only_in_hgcal and not physutils.in_hgcal(z):
+            continue
+        if hit.inEE_:
+            det = 1
+        elif hit.inHsi_:
+            det = 2
+        else:
+            det = 3
+        for track in tracks:
+            if track.trackId() == hit.geantTrackId():
+                pdgid = track.type()
+                break
+        else:
+            pdgid = 0
+        rows.append((
+            x, y, z, hit.layer_, hit.time(), hit.energy(), hit.geantTrackId(), det, pdgid
+            ))
+    return np.array(rows, dtype=np.float64).reshape((-1, 9))
+
+
+@pytest.mark.parametrize('only_in_hgcal', [ True, False ])
+def test_hits_columnar_matches_loop(tree, only_in_hgcal):
+    for i in range(N_EVENTS):
+        calohits, tracks, _ = get_products(tree, i)
+        expected = hits_columnar_loop(calohits, tracks, only_in_hgcal)
+        columnar = get_event(tree, i).get_hits_columnar(only_in_hgcal=only_in_hgcal)
+        assert columnar.shape == expected.shape
+        np.testing.assert_array_equal(columnar, expected)
+
+
+def tracks_columnar_loop(tracks, vertices, only_in_hgcal=True, filter_zero_tracks=True):
+    """
+    Event.get_tracks_columnar as a loop over the track objects
+    """
+    rows = []
+    for track in tracks:
+        position = track.trackerSurfacePosition()
+        x_t, y_t, z_t = position.X(), position.Y(), position.Z()
+        if filter_zero_tracks and x_t == 0. and y_t == 0. and z_t == 0.:
+            continue
+        if track.vertIndex() == -1:
+            continue
+        vertex = vertices[track.vertIndex()]
+        x_v, y_v, z_v = vertex.position().X(), vertex.position().Y(), vertex.position().Z()
+        if only_in_hgcal:
+            if z_t > 0. and (
+                z_t < physutils.hgcal_zmin_pos and z_v < physutils.hgcal_zmin_pos
+                or z_t > physutils.hgcal_zmax_pos and z_v > physutils.hgcal_zmax_pos
+                ):
+                continue
+            elif z_t < 0. and (
+                z_t < physutils.hgcal_zmin_neg and z_v < physutils.hgcal_zmin_neg
+                or z_t > physutils.hgcal_zmax_neg and z_v > physutils.hgcal_zmax_neg
+                ):
+                continue
+        rows.append((x_t, y_t, z_t, x_v, y_v, z_v, track.type(), track.trackId(), vertex.vertexId()))
+    return np.array(rows, dtype=np.float64).reshape((-1, 9))
+
+
+@pytest.mark.parametrize('only_in_hgcal', [ True, False ])
+@pytest.mark.parametrize('filter_zero_tracks', [ True, False ])
+def test_tracks_columnar_matches_loop(tree, only_in_hgcal, filter_zero_tracks):
+    for i in range(N_EVENTS):
+        _, tracks, vertices = get_products(tree, i)
+        expected = tracks_columnar_loop(tracks, vertices, only_in_hgcal, filter_zero_tracks)
+        event = get_event(tree, i)
+        columnar = event.get_tracks_columnar(
+            only_in_hgcal=only_in_hgcal, filter_zero_tracks=filter_zero_tracks
+            )
+        assert columnar.shape == expected.shape
+        np.testing.assert_array_equal(columnar, expected)
+        n_at_origin, n_no_vertex = event.n_skipped_tracks
+        if not filter_zero_tracks:
+            assert n_at_origin == 0
+        assert n_no_vertex == sum(
+            1 for t in tracks if t.vertIndex() == -1 and not(
+                filter_zero_tracks and t.trackerSurfacePosition().X() == 0.
+                and t.trackerSurfacePosition().Y() == 0. and t.trackerSurfacePosition().Z() == 0.
+                )
+            )
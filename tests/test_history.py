@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+History against a naive walk over the track -> vertex -> parent track chain,
+on synthetic events (no ROOT needed)
+"""
+import numpy as np
+import pytest
+
+from hgcalhistory.history import History
+from hgcalhistory.synthetic import generate_arrays
+
+
+@pytest.fixture(scope='module', params=[ 1, 2, 3 ])
+def arrays(request):
+    rng = np.random.RandomState(request.param)
+    hits, tracks, vertices = generate_arrays(rng, n_tracks=300, n_vertices=150, n_hits=3000)
+    return hits, tracks, vertices
+
+
+def naive_parents(tracks, vertices):
+    """
+    Parent track index per track, one track at a time
+    """
+    index_of_id = {}
+    for i, track_id in enumerate(tracks['id']):
+        index_of_id.setdefault(track_id, i)
+    parents = []
+    for i, vertex_index in enumerate(tracks['vertex_index']):
+        parent = -1
+        if 0 <= vertex_index < len(vertices['id']):
+            parent = index_of_id.get(vertices['track_id'][vertex_index], -1)
+        parents.append(-1 if parent == i else parent)
+    return parents, index_of_id
+
+
+def naive_subtree(parents, i):
+    """
+    Indices of the tracks in the subtree of track i, breadth first
+    """
+    subtree = [ i ]
+    frontier = [ i ]
+    while frontier:
+        frontier = [ j for j, parent in enumerate(parents) if parent in frontier ]
+        subtree.extend(frontier)
+    return subtree
+
+
+def test_primary_and_depth_match_walk(arrays):
+    hits, tracks, vertices = arrays
+    history = History(tracks, vertices, hits)
+    parents, _ = naive_parents(tracks, vertices)
+    np.testing.assert_array_equal(history.parent, parents)
+    for i in range(len(parents)):
+        primary, depth = i, 0
+        while parents[primary] != -1:
+            primary = parents[primary]
+            depth += 1
+        assert history.primary[i] == primary
+        assert history.depth[i] == depth
+    assert history.depth.max() > 1
+
+
+def test_hit_ancestry(arrays):
+    hits, tracks, vertices = arrays
+    history = History(tracks, vertices, hits)
+    _, index_of_id = naive_parents(tracks, vertices)
+    ancestry = history.get_hit_ancestry()
+    for i_hit, track_id in enumerate(hits['track_id']):
+        i = index_of_id.get(track_id, -1)
+        if i == -1:
+            assert ancestry['primary'][i_hit] == -1
+            assert ancestry['primary_track_id'][i_hit] == 0
+            assert ancestry['primary_pdgid'][i_hit] == 0
+            assert ancestry['depth'][i_hit] == -1
+        else:
+            primary = history.primary[i]
+            assert ancestry['primary'][i_hit] == primary
+            assert ancestry['primary_track_id'][i_hit] == tracks['id'][primary]
+            assert ancestry['primary_pdgid'][i_hit] == tracks['pdgid'][primary]
+            assert ancestry['depth'][i_hit] == history.depth[i]
+    assert np.any(ancestry['primary'] == -1)
+
+
+def test_subtrees_match_bfs(arrays):
+    hits, tracks, vertices = arrays
+    history = History(tracks, vertices, hits)
+    parents, index_of_id = naive_parents(tracks, vertices)
+    # Primaries have the largest subtrees; leaves the smallest
+    primaries = np.flatnonzero(history.parent == -1)[:5]
+    leaves = np.setdiff1d(np.arange(len(parents)), history.parent)[:5]
+    for i in np.concatenate((primaries, leaves)):
+        track_id = tracks['id'][i]
+        subtree = naive_subtree(parents, i)
+        assert sorted(history.get_descendants(track_id)) == sorted(subtree)
+        assert sorted(history.get_descendant_track_ids(track_id)) == sorted(tracks['id'][subtree])
+        subtree_ids = set(tracks['id'][subtree])
+        hits_expected = [ j for j, hit_track_id in enumerate(hits['track_id']) if hit_track_id in subtree_ids ]
+        assert sorted(history.get_subtree_hits(track_id)) == hits_expected
+        assert history.get_subtree_energy(track_id) == pytest.approx(hits['energy'][hits_expected].sum())
+
+
+def test_unknown_track_id(arrays):
+    hits, tracks, vertices = arrays
+    with pytest.raises(ValueError):
+        History(tracks, vertices, hits).get_descendants(10**9)
+
+
+def test_cycle_raises():
+    tracks = dict(
+        id = np.array([ 1, 2, 3 ], dtype=np.int64),
+        pdgid = np.array([ 22, 11, 11 ], dtype=np.int64),
+        vertex_index = np.array([ 0, 1, 2 ], dtype=np.int64),
+        )
+    # 1 <- 3 <- 2 <- 1
+    vertices = dict(
+        id = np.arange(3, dtype=np.int64),
+        track_id = np.array([ 3, 1, 2 ], dtype=np.int64),
+        )
+    hits = dict(track_id=np.array([ 1 ], dtype=np.int64), energy=np.ones(1))
+    with pytest.raises(ValueError):
+        History(tracks, vertices, hits)
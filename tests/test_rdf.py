@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Needs GEN-SIM root files with the HGCAL hits: set HGCALHISTORY_TEST_FILES
+to a space separated list of (preferably two or more) files.
+"""
+import os
+import numpy as np
+import pytest
+
+ROOT = pytest.importorskip('ROOT')
+import hgcalhistory
+
+ROOTFILES = os.environ.get('HGCALHISTORY_TEST_FILES', '').split()
+pytestmark = pytest.mark.skipif(not ROOTFILES, reason='HGCALHISTORY_TEST_FILES not set')
+
+
+def assert_columnar_equal(columnar, reference):
+    for array, reference_array in zip(columnar, reference):
+        np.testing.assert_array_equal(array, reference_array)
+
+
+@pytest.mark.parametrize('max_events', [ None, 7 ])
+def test_rdf_matches_event_loop_multithreaded(max_events):
+    factory = hgcalhistory.EventFactory(*ROOTFILES, max_events=max_events)
+    reference = factory.get_columnar(backend='python')
+    columnar = factory.get_columnar(backend='rdf', n_threads=4)
+    assert ROOT.IsImplicitMTEnabled()
+    assert len(columnar[1]) == len(factory) + 1
+    assert_columnar_equal(columnar, reference)
+    # Event i of the factory is event i of the output
+    hits, hit_offsets = columnar[:2]
+    for i in [ 0, len(factory) // 2, len(factory) - 1 ]:
+        np.testing.assert_array_equal(
+            hits[hit_offsets[i]:hit_offsets[i+1]], factory.get(i).get_hits_columnar()
+            )
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import numpy as np
+
+import hgcalhistory
+from hgcalhistory.event import Event
+from hgcalhistory.skim import write_skim, SkimFile
+from hgcalhistory.synthetic import generate_events
+
+
+class _File(object):
+    def __init__(self, name):
+        self.name = name
+
+    def GetName(self):
+        return self.name
+
+
+class TwoFileChain(object):
+    """
+    Stands in for a TChain of two files, with 3 and 2 entries
+    """
+    files = [ 'first.root', 'second.root' ]
+    offsets = [ 0, 3, 5 ]
+
+    def __init__(self):
+        self.read_entry = -1
+
+    def GetReadEntry(self):
+        return self.read_entry
+
+    def LoadTree(self, i):
+        self.read_entry = i
+        return i - self.offsets[self.GetTreeNumber()]
+
+    def GetTreeNumber(self):
+        return int(np.searchsorted(self.offsets, self.read_entry, side='right')) - 1
+
+    def GetFile(self):
+        return _File(self.files[self.GetTreeNumber()])
+
+
+def test_skim_stores_entry_in_source_file(tmpdir):
+    chain = TwoFileChain()
+    events = [
+        Event(chain, entry=i, arrays=arrays)
+        for i, arrays in enumerate(generate_events(5, n_tracks=20, n_vertices=10, n_hits=50))
+        ]
+    path = str(tmpdir.join('skim.npz'))
+    assert write_skim(events, path) == 5
+
+    skim = SkimFile(path)
+    assert [ skim.get_source(i) for i in range(len(skim)) ] == [
+        ('first.root', 0), ('first.root', 1), ('first.root', 2),
+        ('second.root', 0), ('second.root', 1),
+        ]
+    # Skimmed events keep the entry in their source file
+    factory = hgcalhistory.EventFactory(path)
+    assert [ (event.source, event.entry) for event in factory ] == [
+        skim.get_source(i) for i in range(len(skim))
+        ]
+    np.testing.assert_array_equal(
+        factory.get(3).get_hit_arrays()['x'], events[3].get_hit_arrays()['x']
+        )